@@ -6,11 +6,16 @@ from airflow import DAG
 # Operators; we need this to operate!
 from airflow.operators.python_operator import PythonOperator
 from airflow.models import Variable
+from airflow.models.xcom_arg import XComArg
+from airflow.decorators import task_group
 # Email when fail: https://stackoverflow.com/questions/51726248/airflow-dag-customized-email-on-any-of-the-task-failure
 #from airflow.operators.email_operator import EmailOperator
 #from airflow.utils.trigger_rule import TriggerRule
 
-from energy import _get_hourly_demand, _calculate_hourly_demand_forecast, _get_monthly_data
+from energy import _get_hourly_demand, _calculate_hourly_demand_forecast, _monitor_forecast_accuracy
+from energy import _backfill_hourly_gaps
+from stan_monthly import _monthly_bayes_forecast
+from energy import _list_monthly_bases, _download_monthly_base, _parse_monthly_base, _load_monthly_base
 
 # These args will get passed on to each operator
 # You can override them on a per-task basis during operator initialization
@@ -26,16 +31,85 @@ default_args = {
 }
 
 # define the python functions
-def get_monthly_data(**kwargs):
+# Monthly load as a task group mapped by month (Airflow >= 2.5 dynamic task mapping): each month runs download >> parse >>
+# load on its own, so a month that fails does not stop the others and a retry only repeats the failed step of that month.
+# _get_monthly_data runs the same in one task.
+def list_monthly_bases(**kwargs):
     database = Variable.get("ENERGY_DB")
     host = Variable.get("ENERGY_DB_HOST")
     user = Variable.get("ENERGY_DB_USER")
     password = Variable.get("ENERGY_DB_PASS")
     port = Variable.get("ENERGY_DB_PORT")
-    # execution_date will be deprecated, use 'data_interval_start' or 'logical_date' instead.
-    process_ok = _get_monthly_data(date=kwargs['logical_date'], database=database, host=host
+    process_ok, bases = _list_monthly_bases(date=kwargs['logical_date'], database=database, host=host
                     , user=user, password=password, port=port, verbose=True)
-    print('INFO get_monthly_data execution: ', kwargs['logical_date'])
+    print('INFO list_monthly_bases execution: ', kwargs['logical_date'], bases)
+    if not process_ok:
+        raise ValueError()
+    # One mapped monthly_base group per item ({'base', 'url'})
+    return bases
+
+def download_monthly_base(base, url):
+    if not _download_monthly_base(base=base, url=url, verbose=True):
+        raise ValueError()
+    return
+
+def parse_monthly_base(base):
+    database = Variable.get("ENERGY_DB")
+    host = Variable.get("ENERGY_DB_HOST")
+    user = Variable.get("ENERGY_DB_USER")
+    password = Variable.get("ENERGY_DB_PASS")
+    port = Variable.get("ENERGY_DB_PORT")
+    if not _parse_monthly_base(base=base, database=database, host=host, user=user, password=password, port=port, verbose=True):
+        raise ValueError()
+    return
+
+def load_monthly_base(base):
+    database = Variable.get("ENERGY_DB")
+    host = Variable.get("ENERGY_DB_HOST")
+    user = Variable.get("ENERGY_DB_USER")
+    password = Variable.get("ENERGY_DB_PASS")
+    port = Variable.get("ENERGY_DB_PORT")
+    if not _load_monthly_base(base=base, database=database, host=host, user=user, password=password, port=port, verbose=True):
+        raise ValueError()
+    return
+
+def monthly_bayes_forecast(**kwargs):
+    database = Variable.get("ENERGY_DB")
+    host = Variable.get("ENERGY_DB_HOST")
+    user = Variable.get("ENERGY_DB_USER")
+    password = Variable.get("ENERGY_DB_PASS")
+    port = Variable.get("ENERGY_DB_PORT")
+    # Only fits when a new month was loaded (one experiment per last month of history)
+    process_ok = _monthly_bayes_forecast(date=kwargs['logical_date'], database=database, host=host, user=user
+                    , password=password, port=port, n_forecast=6, verbose=True)
+    print('INFO monthly_bayes_forecast execution: ', kwargs['logical_date'])
+    if not process_ok:
+        raise ValueError()
+    return
+
+def monitor_monthly_forecast_accuracy(**kwargs):
+    database = Variable.get("ENERGY_DB")
+    host = Variable.get("ENERGY_DB_HOST")
+    user = Variable.get("ENERGY_DB_USER")
+    password = Variable.get("ENERGY_DB_PASS")
+    port = Variable.get("ENERGY_DB_PORT")
+    process_ok = _monitor_forecast_accuracy(date=kwargs['logical_date'], database=database, host=host, user=user
+                    , password=password, port=port, frequency='M', verbose=True)
+    print('INFO monitor_monthly_forecast_accuracy execution: ', kwargs['logical_date'])
+    if not process_ok:
+        raise ValueError()
+    return
+
+def backfill_hourly_gaps(**kwargs):
+    database = Variable.get("ENERGY_DB")
+    host = Variable.get("ENERGY_DB_HOST")
+    user = Variable.get("ENERGY_DB_USER")
+    password = Variable.get("ENERGY_DB_PASS")
+    port = Variable.get("ENERGY_DB_PORT")
+    # Re requests the days with missing hours (cammesa_db.hourly_demand_gaps)
+    process_ok = _backfill_hourly_gaps(database=database, host=host, user=user, password=password, port=port, max_days=7
+                    , verbose=True)
+    print('INFO backfill_hourly_gaps execution: ', kwargs['logical_date'])
     if not process_ok:
         raise ValueError()
     return
@@ -53,10 +127,60 @@ dag = DAG(
 
 # define tasks
 t1 = PythonOperator(
-    task_id='get_monthly_data',
-    python_callable= get_monthly_data,
+    task_id='list_monthly_bases',
+    python_callable= list_monthly_bases,
+    provide_context=True,
+    dag=dag,
+)
+
+@task_group(group_id='monthly_base', dag=dag)
+def monthly_base(base, url):
+    t_download = PythonOperator(
+        task_id='download',
+        python_callable= download_monthly_base,
+        op_kwargs={'base': base, 'url': url},
+        dag=dag,
+    )
+    t_parse = PythonOperator(
+        task_id='parse',
+        python_callable= parse_monthly_base,
+        op_kwargs={'base': base},
+        dag=dag,
+    )
+    # Months are loaded one at a time: each one is a single transaction over the same master tables
+    t_load = PythonOperator(
+        task_id='load',
+        python_callable= load_monthly_base,
+        op_kwargs={'base': base},
+        max_active_tis_per_dag=1,
+        dag=dag,
+    )
+    t_download >> t_parse >> t_load
+
+t1_months = monthly_base.expand_kwargs(XComArg(t1))
+
+t2 = PythonOperator(
+    task_id='monitor_monthly_forecast_accuracy',
+    python_callable= monitor_monthly_forecast_accuracy,
+    provide_context=True,
+    # Runs also when there was no month to load (mapped tasks with no items are skipped)
+    trigger_rule='none_failed',
+    dag=dag,
+)
+
+t3 = PythonOperator(
+    task_id='monthly_bayes_forecast',
+    python_callable= monthly_bayes_forecast,
+    provide_context=True,
+    trigger_rule='none_failed',
+    dag=dag,
+)
+
+t4 = PythonOperator(
+    task_id='backfill_hourly_gaps',
+    python_callable= backfill_hourly_gaps,
     provide_context=True,
     dag=dag,
 )
 
-t1
\ No newline at end of file
+t1 >> t1_months >> t2 >> t3
\ No newline at end of file
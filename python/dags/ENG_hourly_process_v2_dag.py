@@ -10,7 +10,7 @@ from airflow.models import Variable
 #from airflow.operators.email_operator import EmailOperator
 #from airflow.utils.trigger_rule import TriggerRule
 
-from energy import _get_hourly_demand, _calculate_hourly_demand_forecast
+from energy import _get_hourly_demand, _calculate_hourly_demand_forecast, _monitor_forecast_accuracy
 
 # These args will get passed on to each operator
 # You can override them on a per-task basis during operator initialization
@@ -63,12 +63,27 @@ def calculate_hourly_demand_forecast(**kwargs):
     #print('INFO calculate_hourly_demand_forecast execution init: ', kwargs['execution_date'])
     print('INFO calculate_hourly_demand_forecast execution init: ', kwargs['logical_date'])
     process_ok, error_txt = _calculate_hourly_demand_forecast(timestamp_max=kwargs['logical_date'], database=database, host=host, user=user, password=password
-                                                              , port=port, n_lookback=48, n_forecast=24, verbose=True)
+                                                              , port=port, n_lookback=48, n_forecast=24, n_samples=100
+                                                              , stateful=False, verbose=True)
     if not process_ok:
         print('ERROR calculate_hourly_demand_forecast. ' + error_txt)
         raise ValueError()
     return
 
+def monitor_hourly_forecast_accuracy(**kwargs):
+    database = Variable.get("ENERGY_DB")
+    host = Variable.get("ENERGY_DB_HOST")
+    user = Variable.get("ENERGY_DB_USER")
+    password = Variable.get("ENERGY_DB_PASS")
+    port = Variable.get("ENERGY_DB_PORT")
+    # Reads the forecast history: it does not depend on calculate_hourly_demand_forecast, and a failure does not block it
+    process_ok = _monitor_forecast_accuracy(date=kwargs['logical_date'], database=database, host=host, user=user
+                    , password=password, port=port, frequency='H', region_code=1002, verbose=True)
+    print('INFO monitor_hourly_forecast_accuracy execution: ', kwargs['logical_date'])
+    if not process_ok:
+        raise ValueError()
+    return
+
 # define the DAG
 dag = DAG(
     'ENG_hourly_process_v2',
@@ -97,4 +112,11 @@ t2 = PythonOperator(
     dag=dag,
 )
 
-t1 >> t2
\ No newline at end of file
+t3 = PythonOperator(
+    task_id='monitor_hourly_forecast_accuracy',
+    python_callable= monitor_hourly_forecast_accuracy,
+    provide_context=True,
+    dag=dag,
+)
+
+t1 >> [t2, t3]
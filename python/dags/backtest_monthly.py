@@ -0,0 +1,248 @@
+"""
+    backtest_monthly.py
+    Rolling origin backtesting of the monthly demand models (national monthly totals).
+    All the splits are generated up front, the lag/seasonal feature matrix is calculated once and shared with the worker
+    processes as read only shared memory, and (model, origin) pairs run on a process pool. Results are written in bulk to
+    cammesa_db.experiments (one experiment per model and origin) and cammesa_db.experiments_detail.
+"""
+import traceback
+import hashlib
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from sklearn.linear_model import Ridge
+from sklearn.svm import SVR
+from sklearn.preprocessing import StandardScaler
+
+from energy import build_postgres_cnxn, pg_select_to_pandas, upsert
+
+# Columns of the feature matrix: row i only uses the history up to month i-1
+LAGS = list(range(1, 13))
+SEASONAL_LAGS = [24, 36, 48, 60, 72]
+FEATURE_COLS = ['lag_' + str(lag) for lag in LAGS] + ['lag_' + str(lag) for lag in SEASONAL_LAGS] +\
+    ['month_sin', 'month_cos', 'trend']
+
+def build_features(y, months):
+    """ Feature matrix (len(y), len(FEATURE_COLS)) of the series y: lags 1 to 12, same month of the previous 2 to 6 years,
+        month of the year (sin, cos) and trend (years). Missing lags are NaN.
+    """
+    n = len(y)
+    F = np.full((n, len(FEATURE_COLS)), np.nan)
+    for j, lag in enumerate(LAGS + SEASONAL_LAGS):
+        F[lag:, j] = y[:n - lag]
+    month_angle = 2 * np.pi * (months - 1) / 12
+    F[:, -3] = np.sin(month_angle)
+    F[:, -2] = np.cos(month_angle)
+    F[:, -1] = np.arange(n) / 12
+    return F
+
+def _direct_fit_predict(F, y, origin, horizon, cols, estimator=None):
+    """ Direct multi horizon strategy: for each h, fits y[i + h - 1] ~ F[i, cols] with the pairs known at origin and predicts
+        from F[origin]. estimator None: ordinary least squares.
+        Returns None (the pair is skipped) when, for some h, the complete rows (from the longest lag on) are not more than
+        the coefficients or the least squares design matrix is rank deficient: lstsq would return a minimum norm fit.
+    """
+    forecast = np.empty(horizon)
+    for h in range(1, horizon + 1):
+        rows = np.arange(origin - h + 1)
+        rows = rows[~np.isnan(F[rows][:, cols]).any(axis=1)]
+        if len(rows) <= len(cols) + 1:
+            return None
+        X, target = F[rows][:, cols], y[rows + h - 1]
+        x_origin = F[origin, cols].reshape(1, -1)
+        if estimator is None:
+            X1 = np.column_stack([np.ones(len(rows)), X])
+            coef, _, rank, _ = np.linalg.lstsq(X1, target, rcond=None)
+            if rank < X1.shape[1]:
+                return None
+            forecast[h - 1] = coef[0] + x_origin @ coef[1:]
+        else:
+            scaler_x = StandardScaler().fit(X)
+            y_mean, y_std = target.mean(), target.std()
+            model = estimator().fit(scaler_x.transform(X), (target - y_mean) / y_std)
+            forecast[h - 1] = model.predict(scaler_x.transform(x_origin))[0] * y_std + y_mean
+    return forecast
+
+def model_snaive(F, y, origin, horizon):
+    return np.array([y[origin - 12 + (h - 1) % 12] for h in range(1, horizon + 1)])
+
+def model_drift(F, y, origin, horizon):
+    slope = (y[origin - 1] - y[0]) / (origin - 1)
+    return y[origin - 1] + slope * np.arange(1, horizon + 1)
+
+def model_sine(F, y, origin, horizon):
+    # Polygon (trend) + sine (seasonality): least squares on trend, trend^2 and month sin/cos
+    t = F[:origin + horizon, -1]
+    X = np.column_stack([np.ones(len(t)), t, t ** 2, F[:origin + horizon, -3], F[:origin + horizon, -2]])
+    coef = np.linalg.lstsq(X[:origin], y[:origin], rcond=None)[0]
+    return X[origin:] @ coef
+
+def model_linlag(F, y, origin, horizon):
+    return _direct_fit_predict(F, y, origin, horizon, cols=list(range(len(LAGS))))
+
+def model_tlin(F, y, origin, horizon):
+    # Time lagged: last 12 months plus the same month of previous years
+    return _direct_fit_predict(F, y, origin, horizon, cols=list(range(len(LAGS) + len(SEASONAL_LAGS))))
+
+def model_ridge(F, y, origin, horizon):
+    return _direct_fit_predict(F, y, origin, horizon, cols=list(range(len(FEATURE_COLS))), estimator=lambda: Ridge(alpha=1.0))
+
+def model_svr(F, y, origin, horizon):
+    return _direct_fit_predict(F, y, origin, horizon, cols=list(range(len(LAGS))) + [len(FEATURE_COLS) - 3, len(FEATURE_COLS) - 2]
+                               , estimator=lambda: SVR(C=10, epsilon=0.05))
+
+# model_id (cammesa_db.experiments.model_id, up to 10 chars) --> function(F, y, origin, horizon) returning the forecast of
+# y[origin:origin + horizon] using only y[:origin] and F[:origin + 1], or None when the history up to origin is not enough
+# to fit the model (the pair is skipped). Add models here to include them in the backtest.
+BACKTEST_MODELS = {
+    'bt_snaive': model_snaive,
+    'bt_drift': model_drift,
+    'bt_sine': model_sine,
+    'bt_linlag': model_linlag,
+    'bt_tlin': model_tlin,
+    'bt_ridge': model_ridge,
+    'bt_svr': model_svr,
+}
+
+def rolling_origins(n, n_origins, horizon, min_train=84):
+    """ Origins (index of the first forecasted month) of the last n_origins splits with a whole horizon of actuals, never
+        leaving less than min_train months (the longest seasonal lag plus one year) to train.
+    """
+    last_origin = n - horizon
+    return list(range(max(min_train, last_origin - n_origins + 1), last_origin + 1))
+
+# Shared arrays of each worker process, set by _attach_shared
+_shared = {}
+
+def _attach_shared(names, shapes):
+    """ Pool initializer: maps the feature matrix and the series from shared memory as read only arrays.
+    """
+    for key in names:
+        shm = shared_memory.SharedMemory(name=names[key])
+        array = np.ndarray(shapes[key], dtype=np.float64, buffer=shm.buf)
+        array.flags.writeable = False
+        _shared[key] = (shm, array)
+
+def _run_pair(model_id, origin, horizon):
+    """ Returns model_id, origin, forecast (None: failed or skipped) and error_txt ('' when skipped).
+    """
+    F, y = _shared['F'][1], _shared['y'][1]
+    try:
+        return model_id, origin, BACKTEST_MODELS[model_id](F, y, origin, horizon), ''
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        return model_id, origin, None, ' '.join(formatted_lines)
+
+def run_backtest(y, months, n_origins=60, horizon=6, models=None, max_workers=None, verbose=True):
+    """ Runs each (model, origin) pair on a process pool. Returns a DataFrame with model_id, origin (index), horizon
+        (1 to horizon) and forecast; pairs that failed or were skipped (not enough history to fit the model) are reported
+        and left out.
+    """
+    models = models if models else list(BACKTEST_MODELS)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    F = build_features(y, months)
+    origins = rolling_origins(len(y), n_origins, horizon)
+    pairs = [(model_id, origin) for model_id in models for origin in origins]
+    shms = {}
+    results = []
+    skipped = {}
+    try:
+        for key, array in [('F', F), ('y', y)]:
+            shms[key] = shared_memory.SharedMemory(create=True, size=array.nbytes)
+            np.ndarray(array.shape, dtype=np.float64, buffer=shms[key].buf)[:] = array
+        names = {key: shm.name for key, shm in shms.items()}
+        shapes = {'F': F.shape, 'y': y.shape}
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_attach_shared, initargs=(names, shapes)) as executor:
+            chunksize = max(1, len(pairs) // ((max_workers or 8) * 4))
+            for model_id, origin, forecast, error_txt in executor.map(_run_pair, [p[0] for p in pairs], [p[1] for p in pairs]
+                                                                   , [horizon] * len(pairs), chunksize=chunksize):
+                if forecast is None:
+                    if error_txt:
+                        print('ERROR run_backtest - ' + model_id + ' origin ' + str(origin) + ': ' + error_txt)
+                    else:
+                        skipped.setdefault(model_id, []).append(origin)
+                    continue
+                results.append(pd.DataFrame({'model_id': model_id, 'origin': origin, 'horizon': np.arange(1, horizon + 1)
+                                             , 'forecast': forecast}))
+    finally:
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+    if verbose:
+        print('INFO run_backtest - ' + str(len(results)) + ' of ' + str(len(pairs)) + ' (model, origin) pairs run. Models: ' +\
+              str(len(models)) + ' Origins: ' + str(len(origins)))
+    for model_id, model_origins in skipped.items():
+        print('WARNING run_backtest - ' + model_id + ': ' + str(len(model_origins)) + ' origins skipped, not enough history'
+              ' to fit the model (origins ' + str(min(model_origins)) + ' to ' + str(max(model_origins)) + ').')
+    if not results:
+        return pd.DataFrame(columns=['model_id', 'origin', 'horizon', 'forecast'])
+    return pd.concat(results, ignore_index=True)
+
+###### Backtest process
+def _backtest_monthly_models(database, host, user, password, port, n_origins=60, horizon=6, models=None, max_workers=None
+                             , csv_file=None, verbose=True):
+    """ Rolling origin backtest of BACKTEST_MODELS (or models) over the national monthly demand (monthly_demand totals,
+        or csv_file with the format of mdemand.csv). Saves one experiment per model and origin (experiment_date: first
+        forecasted month minus one month, mape over the horizon) and its forecasts with the actual values on
+        experiments_detail, all in one transaction. Returns process_ok and the per horizon MAPE of each model.
+    """
+    error_txt = ''
+    df_mape = pd.DataFrame()
+    process_ok, error_txt, cnxn, cursor = build_postgres_cnxn(database=database, host=host, user=user, password=password
+                                        , port=port, verbose=verbose)
+    if not process_ok:
+        if verbose:
+            print('ERROR _backtest_monthly_models building postgres cnxn: ' + error_txt)
+        return process_ok, df_mape
+    if csv_file:
+        df_hist = pd.read_csv(csv_file, sep=';', decimal=',', index_col=0, parse_dates=['month'])
+    else:
+        sql_query = """SELECT month, SUM(monthly_demand_mwh) AS hist_value
+                    FROM cammesa_db.monthly_demand
+                    GROUP BY month
+                    ORDER BY month"""
+        process_ok, error_txt, df_hist = pg_select_to_pandas(cursor, sql_query, verbose=verbose)
+        if not process_ok:
+            if verbose:
+                print('ERROR _backtest_monthly_models calling subprocess: ' + error_txt)
+            cnxn.close()
+            return process_ok, df_mape
+        df_hist.month = pd.to_datetime(df_hist.month)
+    y = df_hist.hist_value.astype(float).to_numpy()
+    months = df_hist.month.dt.month.to_numpy()
+    df_backtest = run_backtest(y, months, n_origins=n_origins, horizon=horizon, models=models, max_workers=max_workers
+                               , verbose=verbose)
+    # Vectorized scoring and bulk insert
+    df_backtest['month'] = df_hist.month.to_numpy()[df_backtest.origin + df_backtest.horizon - 1]
+    df_backtest['hist_value'] = y[df_backtest.origin + df_backtest.horizon - 1]
+    df_backtest['ape'] = np.abs(df_backtest.forecast - df_backtest.hist_value) / df_backtest.hist_value * 100
+    df_backtest['experiment_date'] = (df_hist.month.to_numpy()[df_backtest.origin - 1])
+    df_backtest['experiment_id'] = (df_backtest.model_id + 'bt' + pd.to_datetime(df_backtest.experiment_date).dt.strftime('%Y%m%d'))\
+        .map(lambda key: hashlib.sha1(str.encode(key)).hexdigest()[:10])
+    df_experiments = df_backtest.groupby(['experiment_id', 'experiment_date', 'model_id'], as_index=False).agg(mape=('ape', 'mean'))
+    df_experiments['experiment_date'] = pd.to_datetime(df_experiments.experiment_date).dt.date
+    df_detail = df_backtest[['experiment_id', 'month', 'hist_value', 'forecast']].rename(columns={'forecast': 'forecast_value'})
+    df_detail['month'] = pd.to_datetime(df_detail.month).dt.date
+    df_mape = df_backtest.pivot_table(index='model_id', columns='horizon', values='ape', aggfunc='mean')
+    try:
+        bool_raise, error_txt, counts = upsert('cammesa_db.experiments', df_experiments, ['experiment_id'], cnxn, cursor
+                                               , commit=False)
+        if not bool_raise:
+            bool_raise, error_txt, counts = upsert('cammesa_db.experiments_detail', df_detail, ['experiment_id', 'month']
+                                                   , cnxn, cursor, commit=False)
+        if bool_raise:
+            raise ValueError(error_txt)
+        cnxn.commit()
+        if verbose:
+            print('INFO _backtest_monthly_models - ' + str(df_experiments.shape[0]) + ' experiments saved. MAPE by horizon:')
+            print(df_mape.round(2))
+    except Exception as err:
+        cnxn.rollback()
+        formatted_lines = traceback.format_exc().splitlines()
+        process_ok = False
+        print('ERROR _backtest_monthly_models - Error saving experiments. Nothing was saved. ' + ' '.join(formatted_lines))
+    cnxn.close()
+    return process_ok, df_mape
@@ -26,7 +26,11 @@ import requests
 # pip install beautifulsoup4
 from bs4 import BeautifulSoup
 
+import re
 import zipfile
+import io
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Librería para obtener el usuario que está ejecutando el script
 import getpass
@@ -111,6 +115,151 @@ def pg_select_to_pandas(cursor, sql_query, verbose=True):
                 print(error_txt)
     return process_ok, error_txt, df
 
+# numpy dtype of the postgres types (pg_type oid) returned by the project queries. Other types are kept as object.
+PG_NUMPY_DTYPES = {16: 'bool', 20: 'int64', 21: 'int16', 23: 'int32', 700: 'float32', 701: 'float64', 1700: 'float64'
+                   , 1082: 'datetime64[D]', 1114: 'datetime64[us]'}
+
+def _rows_to_columns(rows, dtypes):
+    """ List of row tuples to a list of typed numpy arrays (one per column). Integer columns with NULLs become float64
+        and boolean columns with NULLs object (numpy would take NULL as False).
+    """
+    columns = []
+    for i, values in enumerate(zip(*rows)):
+        if dtypes[i] == 'bool' and any(value is None for value in values):
+            columns.append(np.array(values, dtype=object))
+            continue
+        try:
+            columns.append(np.array(values, dtype=dtypes[i]))
+        except (TypeError, ValueError):
+            columns.append(np.array(values, dtype='float64' if dtypes[i].startswith('int') else object))
+    return columns
+
+def pg_select_chunks(cnxn, sql_query, chunk_size=50000, as_numpy=False, verbose=True):
+    """ Streams the result of sql_query with a named (server side) cursor: yields chunks of at most chunk_size rows, as
+        DataFrames or (as_numpy=True) dicts of typed numpy arrays, so the whole result is never held as python tuples.
+        Errors are raised (the caller's task should fail).
+    """
+    cursor = cnxn.cursor(name='pg_select_chunks_' + datetime.now().strftime('%H%M%S%f'))
+    cursor.itersize = chunk_size
+    n_rows = 0
+    try:
+        cursor.execute(sql_query)
+        rows = cursor.fetchmany(chunk_size)
+        colnames = [desc[0] for desc in cursor.description]
+        dtypes = [PG_NUMPY_DTYPES.get(desc[1], 'object') for desc in cursor.description]
+        while rows:
+            n_rows += len(rows)
+            chunk = dict(zip(colnames, _rows_to_columns(rows, dtypes)))
+            yield chunk if as_numpy else pd.DataFrame(chunk)
+            rows = cursor.fetchmany(chunk_size)
+    finally:
+        cursor.close()
+    if verbose:
+        print('INFO pg_select_chunks: query executed Ok. Number of records returned: ' + str(n_rows))
+
+def pg_select_to_pandas_streamed(cnxn, sql_query, chunk_size=50000, verbose=True):
+    """ Same result as pg_select_to_pandas but with typed columns and less memory: counts the rows first, pre allocates one
+        numpy array per column and fills it from the pg_select_chunks stream. If no transaction is open, the count and the
+        fetch run in one REPEATABLE READ transaction (same snapshot, ended after the fetch); otherwise arrays grow if the
+        count falls short.
+    """
+    error_txt = ''
+    process_ok = True
+    df = pd.DataFrame()
+    own_transaction = cnxn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    try:
+        cursor = cnxn.cursor()
+        if own_transaction:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cursor.execute('SELECT COUNT(*) FROM (' + sql_query + ') AS q')
+        n_rows = cursor.fetchone()[0]
+        cursor.close()
+        columns = None
+        i = 0
+        for chunk in pg_select_chunks(cnxn, sql_query, chunk_size=chunk_size, as_numpy=True, verbose=False):
+            n = len(next(iter(chunk.values())))
+            if columns is None:
+                columns = {col: np.empty(max(n_rows, n), dtype=values.dtype) for col, values in chunk.items()}
+            for col, values in chunk.items():
+                if i + n > len(columns[col]):
+                    # Rows inserted after the count (only without an own transaction)
+                    columns[col] = np.concatenate([columns[col], np.empty(max(i + n - len(columns[col]), chunk_size)
+                                                                          , dtype=columns[col].dtype)])
+                dtype = np.result_type(columns[col].dtype, values.dtype)
+                if dtype != columns[col].dtype:
+                    # A later chunk had NULLs on an integer column (or mixed types): widen the whole column, never narrow it
+                    columns[col] = columns[col].astype(dtype)
+                columns[col][i:i+n] = values
+            i += n
+        if columns is not None:
+            df = pd.DataFrame({col: values[:i] for col, values in columns.items()})
+        if verbose:
+            print('INFO pg_select_to_pandas_streamed: query executed Ok. Number of records returned: ' + str(df.shape[0]))
+    except Exception as err:
+        process_ok = False
+        formatted_lines = traceback.format_exc().splitlines()
+        txt = ' '.join(formatted_lines)
+        error_txt = 'ERROR pg_select_to_pandas_streamed: Error executing query on host: ' + cnxn.info.host + ' database ' +\
+              cnxn.info.dbname + ' query: ' + sql_query +'\n' + txt
+        if verbose:
+            print(error_txt)
+    finally:
+        if own_transaction:
+            # Read only transaction started here
+            cnxn.rollback()
+    return process_ok, error_txt, df
+
+def _benchmark_pg_select_variant(variant, cnxn_params, sql_query, chunk_size):
+    """ Runs one variant of benchmark_pg_select on its own connection. Returns rows and seconds.
+    """
+    process_ok, error_txt, cnxn, cursor = build_postgres_cnxn(verbose=False, **cnxn_params)
+    if not process_ok:
+        raise ValueError(error_txt)
+    start = datetime.now()
+    if variant == 'pg_select_to_pandas':
+        n_rows = pg_select_to_pandas(cursor, sql_query, verbose=False)[2].shape[0]
+    elif variant == 'pg_select_to_pandas_streamed':
+        n_rows = pg_select_to_pandas_streamed(cnxn, sql_query, chunk_size, verbose=False)[2].shape[0]
+    elif variant == 'pg_select_chunks':
+        n_rows = sum(chunk.shape[0] for chunk in pg_select_chunks(cnxn, sql_query, chunk_size=chunk_size, verbose=False))
+    else:
+        n_rows = 0
+    seconds = (datetime.now() - start).total_seconds()
+    cnxn.close()
+    return n_rows, seconds
+
+def benchmark_pg_select(database, host, user, password, port, sql_query, chunk_size=50000):
+    """ Peak RSS (MB) and throughput (rows/second) of pg_select_to_pandas, pg_select_to_pandas_streamed and the
+        pg_select_chunks stream (chunks consumed and discarded) for sql_query. Each variant runs in its own process
+        (peak_rss_mb), so libpq result buffers are counted. peak_rss_over_baseline_mb discounts a process that only connects.
+    """
+    cnxn_params = {'database': database, 'host': host, 'user': user, 'password': password, 'port': port}
+    baseline = peak_rss_mb(_benchmark_pg_select_variant, ('baseline', cnxn_params, sql_query, chunk_size))[1]
+    results = []
+    for name in ['pg_select_to_pandas', 'pg_select_to_pandas_streamed', 'pg_select_chunks']:
+        (n_rows, seconds), peak = peak_rss_mb(_benchmark_pg_select_variant, (name, cnxn_params, sql_query, chunk_size))
+        results.append([name, n_rows, seconds, n_rows / seconds if seconds else np.nan, peak, peak - baseline])
+        print('INFO benchmark_pg_select - ' + name + ': ' + str(n_rows) + ' rows, ' + str(seconds) + ' seconds, peak RSS ' +\
+              str(round(peak, 1)) + ' MB (baseline ' + str(round(baseline, 1)) + ' MB).')
+    return pd.DataFrame(data=results, columns=['function', 'rows', 'seconds', 'rows_per_second', 'peak_rss_mb'
+                                               , 'peak_rss_over_baseline_mb'])
+
+def _run_measuring_rss(function, args):
+    """ Runs function(*args) and returns its result with the peak RSS (MB) of the process. Linux: ru_maxrss is in KB.
+    """
+    import resource
+    result = function(*args)
+    return result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def peak_rss_mb(function, args=()):
+    """ Result and peak RSS (MB) of function(*args) run in a new (spawned) process, so every measure starts from the same
+        state and C allocations (libpq, Excel readers) are counted. function and args must be picklable. The peak includes
+        the imports of this module: compare against peak_rss_mb(len, ([],)).
+    """
+    import multiprocessing
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(_run_measuring_rss, function, args).result()
+
 def _url_request_to_pandas(_request, verbose=True):
     error_txt = ''
     process_ok = True
@@ -137,19 +286,6 @@ def _url_request_to_pandas(_request, verbose=True):
             error_txt = 'ERROR api_request_to_pandas: Error requesting API: ' + _request +'\n' + txt
     return process_ok, error_txt, df
 
-def is_holiday(date=datetime.now(), verbose=True):
-    is_a_holiday = 0
-    _request = 'http://nolaborables.com.ar/api/v2/feriados/'+str(date.year)
-    process_ok, error_txt, df_holidays = _url_request_to_pandas(_request, verbose)
-    if not process_ok:
-        if verbose:
-            print('ERROR is_holiday. ' + error_txt)
-    else:
-        is_a_holiday = int(df_holidays[(df_holidays.dia==date.day) & (df_holidays.mes==date.month)].shape[0] > 0)
-        if verbose:
-            print('INFO is_holiday. URL request for ' + str(date) + ' Ok.')
-    return process_ok, error_txt, is_a_holiday
-
 def download_file(url: str, dest_file: str, dest_folder: str, verbose=True):
     bool_raise = False
     error_txt = ''
@@ -179,46 +315,349 @@ def download_file(url: str, dest_file: str, dest_folder: str, verbose=True):
         error_txt = 'Error Downloading & Saiving Report. Url: ' + url + ' To path: ' + file_path + '\n' + txt
     return bool_raise, error_txt
 
-def upsert(table, df, primary_key_cols, cnxn, cursor):
+def upsert_rows(df):
+    """ Columns and rows (tuples) that upsert sends for df. Audit columns are appended to each tuple instead of added to
+        df, so callers don't need to hand over a copy.
+    """
+    user=getpass.getuser()
+    audit_cols = ['create_date', 'create_user', 'update_date', 'update_user']
+    audit_values = (datetime.now(), user, datetime.now(), user)
+    return df.columns.tolist() + audit_cols, [r + audit_values for r in df.itertuples(index=False, name=None)]
+
+def upsert(table, df, primary_key_cols, cnxn, cursor, commit=True):
+    """ Inserts or updates df rows into table. Rows whose content did not change are skipped (not rewritten), so
+        re-processing the same data does not touch update_date nor produce dead tuples.
+        With commit=False the caller owns the transaction (used to load several tables atomically).
+        Returns bool_raise, error_txt and a dict with the count of inserted, updated and skipped rows.
+    """
     bool_raise = False
     error_txt = ''
+    counts = {'inserted': 0, 'updated': 0, 'skipped': 0}
     
-    user=getpass.getuser()
-    df['create_date'] = datetime.now()
-    df['create_user'] = user
-    df['update_date'] = datetime.now()
-    df['update_user'] = user
-    tup = [tuple(r) for r in df.to_numpy()]
+    cols, tup = upsert_rows(df)
         
-    cols_to_insert = f'({(", ".join(df.columns.tolist()))})'
+    cols_to_insert = f'({(", ".join(cols))})'
 
     primary_key = f'({(", ".join(primary_key_cols))})'
-
-    tup = [tuple(r) for r in df.to_numpy()]
     
-    cols_to_update = [col for col in df.columns.tolist() if col not in primary_key_cols + ['create_user', 'create_date']]
+    cols_to_update = [col for col in cols if col not in primary_key_cols + ['create_user', 'create_date']]
     update_sentence = f'{(", ".join([col+"=EXCLUDED."+col for col in cols_to_update]))}'
+    # Audit columns always change, so they are not considered to detect a modified row:
+    cols_to_compare = [col for col in cols_to_update if col not in ['update_user', 'update_date']]
     
-    sql = 'INSERT INTO ' + table + " " + cols_to_insert + " VALUES %s" + " ON CONFLICT " + primary_key + " DO UPDATE "+\
-                        'SET ' + update_sentence + ';'
+    sql = 'INSERT INTO ' + table + ' AS t ' + cols_to_insert + " VALUES %s" + " ON CONFLICT " + primary_key + " DO UPDATE "+\
+                        'SET ' + update_sentence + _distinct_where_clause(cols_to_compare) +\
+                        ' RETURNING (xmax = 0) AS inserted;'
     try:
-        execute_values(cursor, sql, tup)
-        cnxn.commit()
-        print(f'{df.shape[0]} rows upserted to the {table} table')
+        # Skipped rows are not returned by the RETURNING clause:
+        inserted = execute_values(cursor, sql, tup, fetch=True)
+        counts['inserted'] = sum(1 for r in inserted if r[0])
+        counts['updated'] = len(inserted) - counts['inserted']
+        counts['skipped'] = len(tup) - len(inserted)
+        if commit:
+            cnxn.commit()
+        print(f'{df.shape[0]} rows upserted to the {table} table. Inserted: {counts["inserted"]} Updated: {counts["updated"]}' +\
+              f' Skipped (unchanged): {counts["skipped"]}')
     except Exception as err:
         formatted_lines = traceback.format_exc().splitlines()
         txt = ' '.join(formatted_lines)
         bool_raise = True
         error_txt = 'Upsert - SQL Upsert Error. SQL: ' + '\n' + sql + '\n' + txt
+    return bool_raise, error_txt, counts
+
+def _distinct_where_clause(cols_to_compare, alias='t'):
+    """ Builds the WHERE of an ON CONFLICT DO UPDATE so that only rows with some column distinct from the existing
+        one are rewritten.
+    """
+    if not cols_to_compare:
+        return ''
+    return ' WHERE (' + ', '.join([alias+'.'+col for col in cols_to_compare]) + ') IS DISTINCT FROM (' +\
+                ', '.join(['EXCLUDED.'+col for col in cols_to_compare]) + ')'
+
+def get_watermark(source, cursor):
+    """ Returns the watermark (last timestamp loaded) of source from cammesa_db.ingestion_state. None if the source has
+        never been loaded.
+    """
+    watermark = None
+    sql_query = """SELECT watermark
+                FROM cammesa_db.ingestion_state
+                WHERE source = '""" + source + """'"""
+    process_ok, error_txt, df_state = pg_select_to_pandas(cursor, sql_query, verbose=False)
+    if not process_ok:
+        error_txt = 'ERROR get_watermark calling subprocess: ' + error_txt
+    elif df_state.shape[0] > 0:
+        watermark = df_state.watermark[0]
+    return process_ok, error_txt, watermark
+
+def set_watermark(source, watermark, cursor):
+    """ Advances the watermark of source on cammesa_db.ingestion_state (it never moves backwards).
+        It does not commit: call it inside the transaction that loads the data, so both are committed together.
+    """
+    bool_raise = False
+    error_txt = ''
+    upsert_user = getpass.getuser()
+    sql = """INSERT INTO cammesa_db.ingestion_state AS t
+            (source, watermark, create_user, create_date, update_user, update_date) VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (source) DO UPDATE
+            SET watermark=GREATEST(t.watermark, EXCLUDED.watermark), update_user=EXCLUDED.update_user
+            , update_date=EXCLUDED.update_date
+            WHERE t.watermark < EXCLUDED.watermark;
+            """
+    try:
+        cursor.execute(sql, (source, watermark, upsert_user, datetime.now(), upsert_user, datetime.now()))
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        txt = ' '.join(formatted_lines)
+        bool_raise = True
+        error_txt = 'set_watermark - Error advancing watermark of source ' + source + '\n' + txt
     return bool_raise, error_txt
 
+def get_holidays(years, cnxn, cursor, refresh_days=7, verbose=True):
+    """ Returns the set of holidays (datetime.date) of the years list, kept on cammesa_db.holidays. A year is requested to
+        the API when it was never loaded (source 'holidays_YYYY' on cammesa_db.ingestion_state) or, while it can still
+        change (last request before the end of the year), when the last request is older than refresh_days: holidays
+        decreed during the year (bridge days) are picked up. If a refresh fails the stored holidays are used.
+    """
+    holidays = set()
+    for year in sorted(set(years)):
+        source = 'holidays_' + str(year)
+        sql_query = """SELECT watermark, COALESCE(update_date, create_date) AS last_request
+                    FROM cammesa_db.ingestion_state
+                    WHERE source = '""" + source + """'"""
+        process_ok, error_txt, df_state = pg_select_to_pandas(cursor, sql_query, verbose=False)
+        if not process_ok:
+            break
+        loaded = df_state.shape[0] > 0
+        last_request = df_state.last_request[0] if loaded else None
+        if not loaded or (last_request is not None and last_request < datetime(year + 1, 1, 1) and
+                          last_request < datetime.now() - timedelta(days=refresh_days)):
+            _request = 'http://nolaborables.com.ar/api/v2/feriados/'+str(year)
+            process_ok, error_txt, df_holidays = _url_request_to_pandas(_request, verbose)
+            if not process_ok and loaded:
+                print('WARNING get_holidays - Holidays of ' + str(year) + ' could not be refreshed. Stored ones are used. ' + error_txt)
+                process_ok = True
+            elif not process_ok:
+                break
+            else:
+                df = pd.DataFrame()
+                df['holiday_date'] = pd.to_datetime(dict(year=year, month=df_holidays.mes, day=df_holidays.dia)).dt.date
+                df['holiday_desc'] = df_holidays.motivo.str[:100] if 'motivo' in df_holidays.columns else ''
+                df.drop_duplicates(subset=['holiday_date'], inplace=True)
+                try:
+                    # Holidays moved or removed by a decree are deleted; the year is replaced in one transaction
+                    cursor.execute("""DELETE FROM cammesa_db.holidays WHERE holiday_date BETWEEN %s AND %s""",
+                                   (datetime(year, 1, 1).date(), datetime(year, 12, 31).date()))
+                    bool_raise, error_txt, counts = upsert('cammesa_db.holidays', df, ['holiday_date'], cnxn, cursor, commit=False)
+                    if not bool_raise:
+                        bool_raise, error_txt = set_watermark(source, datetime(year, 12, 31), cursor)
+                    if not bool_raise:
+                        # The watermark does not change on a refresh: update_date keeps the time of the last request
+                        cursor.execute("""UPDATE cammesa_db.ingestion_state SET update_user = %s, update_date = %s
+                                       WHERE source = %s""", (getpass.getuser(), datetime.now(), source))
+                except Exception as err:
+                    formatted_lines = traceback.format_exc().splitlines()
+                    bool_raise = True
+                    error_txt = 'Error saving holidays of ' + str(year) + ' ' + ' '.join(formatted_lines)
+                if bool_raise:
+                    cnxn.rollback()
+                    process_ok = False
+                    break
+                cnxn.commit()
+        sql_query = """SELECT holiday_date
+                    FROM cammesa_db.holidays
+                    WHERE holiday_date BETWEEN '""" + str(year) + """-01-01' AND '""" + str(year) + """-12-31'"""
+        process_ok, error_txt, df_holidays = pg_select_to_pandas(cursor, sql_query, verbose=False)
+        if not process_ok:
+            break
+        holidays.update(df_holidays.holiday_date.tolist())
+    if not process_ok:
+        error_txt = 'ERROR get_holidays. ' + error_txt
+        if verbose:
+            print(error_txt)
+    return process_ok, error_txt, holidays
+
+# Data quality rules of the hourly API data
+HOURLY_DEMAND_MAX = 40000           # MWh, well above the historic peak of the national demand
+HOURLY_TEMP_RANGE = (-20, 50)       # Celsius
+HOURLY_SPIKE_RATIO = 0.25           # An hour above (or below) both neighbours by more than this ratio is an outlier
+
+def validate_hourly_demand(df_demand, day):
+    """ Data quality gate of the hours returned by the API for day (datetime.date requested). Vectorized rules, the first
+        one that fails is the reason of the rejection:
+        out_of_day: the API returns the hours (day 00:00, day+1 00:00]: the 00:00 of a day comes with the day before.
+        duplicated: repeated timestamp (the last one is kept). nan_demand, negative_demand, demand_over_max and
+        demand_spike (against both consecutive neighbours; the last hour has no next one yet, so it is checked against
+        the previous one only: otherwise a spike would be loaded and only be rejected by the next run).
+        Temperature does not reject the hour (the demand is still valid): NaN or out of range values are set to NaN and
+        flagged on column temp_flag ('missing' / 'out_of_range', None if Ok).
+        Returns df_valid (sorted by fecha, so timestamps are strictly increasing) and df_rejected (with column reason).
+        Missing hours are not rejections: they are tracked by update_hourly_gaps.
+        A spike that arrives as the last hour of the run:
+        >>> df = pd.DataFrame({'fecha': pd.date_range('2023-05-02 01:00', periods=3, freq='1H'),
+        ...                    'dem': [15000., 15200., 21000.], 'temp': [15., 15., 14.]})
+        >>> validate_hourly_demand(df, pd.Timestamp('2023-05-02').date())[1].reason.tolist()
+        ['demand_spike']
+    """
+    df = df_demand.sort_values('fecha', kind='stable').copy()
+    day_start = pd.Timestamp(day)
+    dem = df.dem.astype(float)
+    consecutive_prev = df.fecha.diff() == pd.Timedelta(hours=1)
+    consecutive_next = df.fecha.diff(-1) == pd.Timedelta(hours=-1)
+    ratio_prev = (dem / dem.shift(1) - 1).where(consecutive_prev)
+    ratio_next = (dem / dem.shift(-1) - 1).where(consecutive_next)
+    spike = ((ratio_prev > HOURLY_SPIKE_RATIO) & (ratio_next > HOURLY_SPIKE_RATIO)) |\
+            ((ratio_prev < -HOURLY_SPIKE_RATIO) & (ratio_next < -HOURLY_SPIKE_RATIO))
+    # Newest hour: the next run would compare it with both neighbours when it is already loaded
+    is_last = pd.Series(np.arange(df.shape[0]) == df.shape[0] - 1, index=df.index)
+    spike |= is_last & (ratio_prev.abs() > HOURLY_SPIKE_RATIO)
+    rules = [
+        ('out_of_day', (df.fecha <= day_start) | (df.fecha > day_start + pd.Timedelta(days=1))),
+        ('duplicated', df.fecha.duplicated(keep='last')),
+        ('nan_demand', dem.isna()),
+        ('negative_demand', dem < 0),
+        ('demand_over_max', dem > HOURLY_DEMAND_MAX),
+        ('demand_spike', spike),
+    ]
+    reason = pd.Series(np.select([mask.to_numpy() for _, mask in rules], [name for name, _ in rules], default=''), index=df.index)
+    temp = df.temp.astype(float)
+    df['temp_flag'] = None
+    df.loc[~temp.between(*HOURLY_TEMP_RANGE), 'temp_flag'] = 'out_of_range'
+    df.loc[temp.isna(), 'temp_flag'] = 'missing'
+    df['temp'] = temp.where(df.temp_flag.isna())
+    df_rejected = df[reason != ''].assign(reason=reason[reason != ''])
+    return df[reason == ''], df_rejected
+
+def update_hourly_gaps(region_code, window_start, window_end, cursor, since=None):
+    """ Updates cammesa_db.hourly_demand_gaps after loading the hours [window_start, window_end] of region_code: the
+        missing hours of the window (and, with since (previous watermark), the ones after since not seen by any run) are
+        recalculated from hourly_demand and merged with the gaps that touch them. Only the window and those gaps are read.
+        It does not commit: call it inside the transaction that loads the data. Returns bool_raise, error_txt, df_gaps (gaps
+        of the window).
+    """
+    bool_raise = False
+    error_txt = ''
+    df_gaps = pd.DataFrame(columns=['gap_start', 'gap_end'])
+    one_hour = pd.Timedelta(hours=1)
+    lo, hi = pd.Timestamp(window_start), pd.Timestamp(window_end)
+    if since is not None and pd.Timestamp(since) + one_hour < lo:
+        lo = pd.Timestamp(since) + one_hour
+    try:
+        # Gaps overlapping or adjacent to the window are merged
+        sql_query = """SELECT gap_start, gap_end
+                    FROM cammesa_db.hourly_demand_gaps
+                    WHERE region_code = """ + str(region_code) + """
+                    AND gap_end >= '""" + (lo - one_hour).strftime('%Y-%m-%d %H:%M') + """'
+                    AND gap_start <= '""" + (hi + one_hour).strftime('%Y-%m-%d %H:%M') + """'"""
+        process_ok, error_txt, df_old = pg_select_to_pandas(cursor, sql_query, verbose=False)
+        if not process_ok:
+            raise ValueError(error_txt)
+        if df_old.shape[0] > 0:
+            lo, hi = min(lo, pd.Timestamp(df_old.gap_start.min())), max(hi, pd.Timestamp(df_old.gap_end.max()))
+        sql_query = """SELECT timestamp
+                    FROM cammesa_db.hourly_demand
+                    WHERE region_code = """ + str(region_code) + """
+                    AND timestamp BETWEEN '""" + lo.strftime('%Y-%m-%d %H:%M') + """' AND '""" + hi.strftime('%Y-%m-%d %H:%M') + """'"""
+        process_ok, error_txt, df_present = pg_select_to_pandas(cursor, sql_query, verbose=False)
+        if not process_ok:
+            raise ValueError(error_txt)
+        hours = pd.date_range(start=lo, end=hi, freq='1H')
+        missing = pd.Series(hours[~hours.isin(pd.to_datetime(df_present.timestamp))])
+        if missing.shape[0] > 0:
+            # Consecutive missing hours --> one range
+            gap_id = (missing.diff() != one_hour).cumsum()
+            df_gaps = missing.groupby(gap_id).agg(['min', 'max']).rename(columns={'min': 'gap_start', 'max': 'gap_end'})
+        cursor.execute("""DELETE FROM cammesa_db.hourly_demand_gaps
+                        WHERE region_code = %s AND gap_end >= %s AND gap_start <= %s""",
+                       (region_code, lo.to_pydatetime(), hi.to_pydatetime()))
+        if df_gaps.shape[0] > 0:
+            upsert_user = getpass.getuser()
+            tup = [(region_code, r.gap_start.to_pydatetime(), r.gap_end.to_pydatetime(), upsert_user, datetime.now()
+                    , upsert_user, datetime.now()) for r in df_gaps.itertuples(index=False)]
+            execute_values(cursor, """INSERT INTO cammesa_db.hourly_demand_gaps
+                            (region_code, gap_start, gap_end, create_user, create_date, update_user, update_date) VALUES %s""", tup)
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        bool_raise = True
+        error_txt = 'update_hourly_gaps - Error updating gaps of region ' + str(region_code) + '\n' + ' '.join(formatted_lines)
+    return bool_raise, error_txt, df_gaps
+
+def get_hourly_gaps(region_code, from_timestamp, to_timestamp, cursor):
+    """ Gaps (missing hour ranges) of region_code that overlap [from_timestamp, to_timestamp], from
+        cammesa_db.hourly_demand_gaps (indexed lookup, hourly_demand is not read). None: no limit. Most recent first.
+    """
+    sql_query = """SELECT gap_start, gap_end
+                FROM cammesa_db.hourly_demand_gaps
+                WHERE region_code = """ + str(region_code)
+    if from_timestamp is not None:
+        sql_query += """ AND gap_end >= '""" + from_timestamp.strftime('%Y-%m-%d %H:%M') + """'"""
+    if to_timestamp is not None:
+        sql_query += """ AND gap_start <= '""" + to_timestamp.strftime('%Y-%m-%d %H:%M') + """'"""
+    sql_query += """ ORDER BY gap_start DESC"""
+    process_ok, error_txt, df_gaps = pg_select_to_pandas(cursor, sql_query, verbose=False)
+    if not process_ok:
+        error_txt = 'ERROR get_hourly_gaps calling subprocess: ' + error_txt
+    return process_ok, error_txt, df_gaps
+
+def record_rejected_hours(region_code, df_rejected, loaded_timestamps, cursor):
+    """ Keeps on cammesa_db.hourly_demand_rejected the hours rejected by validate_hourly_demand for their demand (they stay
+        as gaps; _backfill_hourly_gaps does not request them again) and removes the ones loaded now (loaded_timestamps).
+        out_of_day and duplicated rows are not missing hours, so they are not recorded. It does not commit.
+    """
+    bool_raise = False
+    error_txt = ''
+    try:
+        if len(loaded_timestamps) > 0:
+            cursor.execute("""DELETE FROM cammesa_db.hourly_demand_rejected
+                            WHERE region_code = %s AND timestamp = ANY(%s)""",
+                           (region_code, [pd.Timestamp(ts).to_pydatetime() for ts in loaded_timestamps]))
+        df = df_rejected[~df_rejected.reason.isin(['out_of_day', 'duplicated'])]
+        if df.shape[0] > 0:
+            upsert_user = getpass.getuser()
+            tup = [(region_code, r.fecha.to_pydatetime(), None if pd.isna(r.dem) else float(r.dem), r.reason, upsert_user
+                    , datetime.now(), upsert_user, datetime.now()) for r in df.itertuples(index=False)]
+            execute_values(cursor, """INSERT INTO cammesa_db.hourly_demand_rejected AS t
+                            (region_code, timestamp, hourly_demand, reason, create_user, create_date, update_user, update_date)
+                            VALUES %s ON CONFLICT (region_code, timestamp) DO UPDATE
+                            SET hourly_demand=EXCLUDED.hourly_demand, reason=EXCLUDED.reason, update_user=EXCLUDED.update_user
+                            , update_date=EXCLUDED.update_date""", tup)
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        bool_raise = True
+        error_txt = 'record_rejected_hours - Error saving rejected hours of region ' + str(region_code) + '\n' +\
+            ' '.join(formatted_lines)
+    return bool_raise, error_txt
+
+def fill_hourly_window(df_hours, start, end, max_missing_hours=2):
+    """ Demand of every hour of [start, end] from df_hours (timestamp, hourly_demand): up to max_missing_hours missing
+        hours are linearly interpolated (the LSTM window must be regular). Returns process_ok, error_txt and the values
+        (np.array), None if more hours are missing.
+    """
+    hours = pd.date_range(start=start, end=end, freq='1H')
+    values = df_hours.set_index(pd.to_datetime(df_hours.timestamp)).hourly_demand.astype(float).reindex(hours)
+    n_missing = int(values.isna().sum())
+    if n_missing > max_missing_hours:
+        return False, 'ERROR fill_hourly_window: ' + str(n_missing) + ' missing hours between ' + str(start) + ' and ' +\
+            str(end) + ' (tolerance: ' + str(max_missing_hours) + ').', None
+    if n_missing > 0:
+        print('WARNING fill_hourly_window - ' + str(n_missing) + ' missing hours interpolated: ' +\
+              ', '.join(values[values.isna()].index.strftime('%Y-%m-%d %H:%M')))
+        values = values.interpolate(method='linear', limit_direction='both')
+    return True, '', values.to_numpy()
+
 #*************************************************************
 # ROUTINES for DAGs
 #*************************************************************
 ###### Hourly process:
+# Id of the pre trained model used by _calculate_hourly_demand_forecast (saved on hourly_demand_forecast.model_id)
+HOURLY_MODEL_ID = 'lstm_24'
+#HOURLY_MODEL_FILE = '/opt/airflow/dags/lstm_24_model.h5'
+HOURLY_MODEL_FILE = '/home/colmo/airflow/dags/lstm_24_model.h5'
+
 def _get_hourly_demand(date, database, host, user, password, port, verbose=True):
     """ Asks API for hourly data of the day (from PARAM date %Y-%m-%d %H:%M) and upserts hourly_demand table.
-        NOTE: demand values sometimes come in Nan. This modules ends with error in these cases.
+        NOTE: demand values sometimes come in Nan. Records are checked by validate_hourly_demand: rejected ones are logged,
+        not loaded and kept on cammesa_db.hourly_demand_rejected (record_rejected_hours); bad temperatures are only flagged.
+        The missing hours are kept on cammesa_db.hourly_demand_gaps (update_hourly_gaps).
         NOTE: values for 00:00 Hour comes with the data form the day before! So there is an special treatment for this situation
     """
     error_txt = ''
@@ -252,39 +691,285 @@ def _get_hourly_demand(date, database, host, user, password, port, verbose=True)
             # you retrieve the data by the logical time it should have been triggered. 
             # So you have to filter hours after logical date.hour
             df_demand = df_demand[(df_demand.fecha.dt.minute==0) & (df_demand.fecha <= date.strftime('%Y-%m-%d %H:%M'))]
-            # demand values can come as Nan --> exclude those records.
-            df_demand.dropna(axis=0, subset=['dem'], inplace=True)
+            # Data quality gate: NaN, negative or outlier demand, hours of other days... (temperatures are only flagged)
+            request_day = yesterday if date.hour == 0 else date.date()
+            df_demand, df_rejected = validate_hourly_demand(df_demand, request_day)
+            if df_rejected.shape[0] > 0:
+                print('WARNING get_hourly_demand - ' + str(df_rejected.shape[0]) + ' records rejected by the quality rules: ' +\
+                    ', '.join([reason + ': ' + str(n) for reason, n in df_rejected.reason.value_counts().items()]) +\
+                    '. Timestamps: ' + ', '.join(df_rejected.fecha.dt.strftime('%Y-%m-%d %H:%M')))
             hours = date.hour
             # As hours start in 1, we should ask directly for hour:
             if df_demand.shape[0]<hours:
+                # Missing hours are loaded by the next runs or by _backfill_hourly_gaps (see cammesa_db.hourly_demand_gaps)
                 if verbose:
                     print('INFO get_hourly_demand - Data retrieved form API is incomplete. Date: ' + str(date) +\
                         ' Hour: ' + str(hours) + ' # of records Ok (should be == to Hour+1): '+ str(df_demand.shape[0]))
-            else:
+            if df_demand.shape[0] == 0 and df_rejected.shape[0] > 0:
+                bool_raise, error_txt = record_rejected_hours(1002, df_rejected, [], cursor)
+                if bool_raise:
+                    cnxn.rollback()
+                    process_ok = False
+                    print('ERROR get_hourly_demand - ' + error_txt)
+                else:
+                    cnxn.commit()
+            if df_demand.shape[0] > 0:
+                df_demand = df_demand[['fecha', 'dem', 'temp', 'temp_flag']].copy()
                 df_demand.dem = df_demand.dem.astype(int)
+                # Flagged temperatures are saved as NULL
+                df_demand['temp'] = df_demand.temp.astype(object).where(df_demand.temp.notna(), None)
                 df_demand['day_of_week'] = df_demand.fecha.dt.dayofweek
-                process_ok, error_txt, is_a_holiday = is_holiday(date.date(), verbose=verbose)
+                process_ok, error_txt, holidays = get_holidays(df_demand.fecha.dt.year.unique().tolist(), cnxn, cursor
+                                                               , verbose=verbose)
                 if not process_ok:
                     if verbose:
                         print(error_txt)
                     cnxn.close()
+                    return process_ok
                 else:
-                    df_demand['is_holiday'] = is_a_holiday
+                    # By row: the 00:00 hour belongs to the next day
+                    df_demand['is_holiday'] = df_demand.fecha.dt.date.isin(holidays).astype(int)
+                    process_ok, error_txt, since = get_watermark('hourly_demand_1002', cursor)
+                    if not process_ok:
+                        print('ERROR get_hourly_demand - ' + error_txt)
+                        cnxn.close()
+                        return process_ok
                     upsert_user=getpass.getuser()
                     tup = [tuple(np.append(np.append([1002], r), [upsert_user, datetime.now(), upsert_user, datetime.now()])) \
                             for r in df_demand.to_numpy()]
-                    sql = 'INSERT INTO cammesa_db.hourly_demand '+\
-                        '(region_code, timestamp, hourly_demand, hourly_temp, day_of_week, is_holiday, create_user, create_date, '+\
-                        'update_user, update_date) VALUES %s ON CONFLICT (region_code, timestamp) DO UPDATE '+\
-                        'SET hourly_demand=EXCLUDED.hourly_demand, hourly_temp=EXCLUDED.hourly_temp, day_of_week=EXCLUDED.day_of_week, '+\
-                        'is_holiday=EXCLUDED.is_holiday, update_user=EXCLUDED.update_user, update_date=EXCLUDED.update_date;'
-                    execute_values(cursor, sql, tup)
+                    # Hours already loaded with the same values are skipped (not rewritten):
+                    sql = 'INSERT INTO cammesa_db.hourly_demand AS t '+\
+                        '(region_code, timestamp, hourly_demand, hourly_temp, temp_flag, day_of_week, is_holiday, create_user, '+\
+                        'create_date, update_user, update_date) VALUES %s ON CONFLICT (region_code, timestamp) DO UPDATE '+\
+                        'SET hourly_demand=EXCLUDED.hourly_demand, hourly_temp=EXCLUDED.hourly_temp, temp_flag=EXCLUDED.temp_flag, '+\
+                        'day_of_week=EXCLUDED.day_of_week, is_holiday=EXCLUDED.is_holiday, update_user=EXCLUDED.update_user, '+\
+                        'update_date=EXCLUDED.update_date'+\
+                        _distinct_where_clause(['hourly_demand', 'hourly_temp', 'temp_flag', 'day_of_week', 'is_holiday']) +\
+                        ' RETURNING (xmax = 0) AS inserted;'
+                    inserted = execute_values(cursor, sql, tup, fetch=True)
+                    # Watermark is advanced in the same transaction as the data:
+                    bool_raise, error_txt = set_watermark('hourly_demand_1002', df_demand.fecha.max().to_pydatetime(), cursor)
+                    if not bool_raise:
+                        bool_raise, error_txt = record_rejected_hours(1002, df_rejected, df_demand.fecha.tolist(), cursor)
+                    if not bool_raise:
+                        # Gap index of the hours expected so far (the hours not published yet are filled by next runs)
+                        window_start = pd.Timestamp(request_day) + pd.Timedelta(hours=1)
+                        window_end = min(pd.Timestamp(date.strftime('%Y-%m-%d %H:00')), pd.Timestamp(request_day) + pd.Timedelta(days=1))
+                        bool_raise, error_txt, df_gaps = update_hourly_gaps(1002, window_start, window_end, cursor, since=since)
+                    if bool_raise:
+                        cnxn.rollback()
+                        process_ok = False
+                        print('ERROR get_hourly_demand - ' + error_txt)
+                        cnxn.close()
+                        return process_ok
                     cnxn.commit()
-                    print('INFO get_hourly_demand - ' + str(len(tup)) + ' records were upserted. Table cammesa_db.hourly_demand.')
+                    n_inserted = sum(1 for r in inserted if r[0])
+                    print('INFO get_hourly_demand - ' + str(len(tup)) + ' records were upserted. Table cammesa_db.hourly_demand.' +\
+                        ' Inserted: ' + str(n_inserted) + ' Updated: ' + str(len(inserted) - n_inserted) +\
+                        ' Skipped (unchanged): ' + str(len(tup) - len(inserted)) +\
+                        ' Missing hour ranges (window): ' + str(df_gaps.shape[0]))
         cnxn.close()
     return process_ok
     
-def _calculate_hourly_demand_forecast(timestamp_max, database, host, user, password, port, n_lookback=48, n_forecast=24, verbose=True):
+def forecast_quantiles(model, X_, scaler, n_samples=100, quantiles=(0.1, 0.5, 0.9)):
+    """ Prediction intervals by MC dropout: the input window X_ (1, n_lookback, 1) is repeated n_samples times and run through
+        model in one batched call with dropout active (training=True), so each sample gets its own dropout mask.
+        Returns an array (len(quantiles), n_forecast) in the original scale. Only for models with dropout (model_has_dropout):
+        without it all the samples are the same.
+    """
+    X_samples = np.repeat(X_, n_samples, axis=0)
+    Y_samples = np.asarray(model(X_samples, training=True))
+    Y_samples = scaler.inverse_transform(Y_samples.reshape(-1, 1)).reshape(n_samples, -1)
+    return np.quantile(Y_samples, quantiles, axis=0)
+
+def model_has_dropout(model):
+    """ True if any layer of model is a Dropout layer or has a non zero dropout / recurrent_dropout.
+    """
+    return any(isinstance(layer, tf.keras.layers.Dropout) or getattr(layer, 'dropout', 0) or getattr(layer, 'recurrent_dropout', 0)
+               for layer in model.layers)
+
+def bootstrap_quantiles(Y_, last_timestamp, cursor, region_code=1002, model_id=HOURLY_MODEL_ID, n_samples=100, days=28
+                        , min_residuals=48, quantiles=(0.1, 0.5, 0.9), seed=None):
+    """ Prediction intervals by bootstrap of the recent errors of the model: relative errors (actual / forecast - 1) of the
+        forecasts of the last days (cammesa_db.hourly_demand_forecast_history vs cammesa_db.hourly_demand) are resampled
+        n_samples times for each horizon and applied to the point forecast Y_ (n_forecast values). A horizon with less than
+        min_residuals errors uses the errors of all horizons. Returns process_ok, error_txt and an array
+        (len(quantiles), n_forecast), None while there are not enough errors.
+    """
+    Y_quantiles = None
+    sql_query = """SELECT (EXTRACT(EPOCH FROM (f.timestamp - f.forecast_base_timestamp)) / 3600)::int AS horizon
+                , d.hourly_demand::float / f.hourly_demand_forecast - 1 AS residual
+                FROM cammesa_db.hourly_demand_forecast_history f
+                JOIN cammesa_db.hourly_demand d ON d.region_code = f.region_code AND d.timestamp = f.timestamp
+                WHERE f.region_code = """ + str(region_code) + """ AND f.model_id = '""" + model_id + """'
+                AND f.timestamp > '""" + (last_timestamp + timedelta(days=-days)).strftime('%Y-%m-%d %H:%M') + """'
+                AND f.timestamp <= '""" + last_timestamp.strftime('%Y-%m-%d %H:%M') + """'
+                AND f.hourly_demand_forecast > 0"""
+    process_ok, error_txt, df_residuals = pg_select_to_pandas(cursor, sql_query, verbose=False)
+    if not process_ok:
+        return process_ok, 'ERROR bootstrap_quantiles calling subprocess: ' + error_txt, Y_quantiles
+    if df_residuals.shape[0] < min_residuals:
+        return process_ok, error_txt, Y_quantiles
+    rng = np.random.default_rng(seed)
+    pooled = df_residuals.residual.to_numpy(dtype=float)
+    by_horizon = {h: r.to_numpy(dtype=float) for h, r in df_residuals.groupby('horizon').residual}
+    Y_ = np.asarray(Y_, dtype=float).flatten()
+    samples = np.empty((n_samples, len(Y_)))
+    for h in range(1, len(Y_) + 1):
+        residuals = by_horizon.get(h, pooled)
+        residuals = residuals if len(residuals) >= min_residuals else pooled
+        samples[:, h - 1] = Y_[h - 1] * (1 + rng.choice(residuals, size=n_samples))
+    Y_quantiles = np.quantile(samples, quantiles, axis=0)
+    return process_ok, error_txt, Y_quantiles
+
+def lstm_initial_states(model):
+    """ Zero [h, c] states of each LSTM layer of model (batch of 1).
+    """
+    return [[tf.zeros((1, layer.units)), tf.zeros((1, layer.units))] for layer in model.layers
+            if isinstance(layer, tf.keras.layers.LSTM)]
+
+def lstm_advance(model, xs, states):
+    """ Advances the LSTM layers of model (and the layers between them) one timestep for each value of xs (scaled), from
+        states. Returns the output of the last LSTM layer and the new states.
+    """
+    last_lstm = max(i for i, layer in enumerate(model.layers) if isinstance(layer, tf.keras.layers.LSTM))
+    out = None
+    for x_t in xs:
+        out = tf.constant([[x_t]], dtype=tf.float32)
+        new_states = []
+        for layer in model.layers[:last_lstm + 1]:
+            if isinstance(layer, tf.keras.layers.LSTM):
+                out, state = layer.cell(out, states[len(new_states)], training=False)
+                new_states.append(state)
+            elif new_states:
+                out = layer(out, training=False)
+        states = new_states
+    return out, states
+
+def lstm_head(model, out):
+    """ Applies the layers after the last LSTM layer of model (the forecast head) to its output.
+    """
+    last_lstm = max(i for i, layer in enumerate(model.layers) if isinstance(layer, tf.keras.layers.LSTM))
+    for layer in model.layers[last_lstm + 1:]:
+        out = layer(out, training=False)
+    return np.asarray(out)
+
+def stateful_lstm_forecast(model, model_hash, last_timestamp, n_lookback, cnxn, cursor, region_code=1002, max_steps=None
+                           , max_missing_hours=2, verbose=True):
+    """ Forecast from the LSTM state saved on cammesa_db.hourly_lstm_state by the previous run, advanced with the hours
+        arrived since then (usually one): reads and computes O(1) hours instead of the whole n_lookback window.
+        The window is replayed from scratch (same result as model.predict over it) when there is no state, the model
+        changed (model_hash), there is a gap or a re processing of the past, an hour already in the state was revised
+        (hourly_demand.update_date later than the state's), or the state was advanced more than max_steps hours (default
+        n_lookback) since the last replay. The min max scaler is fitted on each replay and kept with the
+        state, so advanced forecasts approximate the windowed ones and the replay bounds the drift.
+        The new state is saved without commit: it is committed with the forecast. Returns process_ok, error_txt, Y_
+        (forecast in MWh, shape (-1, 1)).
+    """
+    Y_ = None
+    max_steps = max_steps if max_steps else n_lookback
+    sql_query = """SELECT state_timestamp, model_hash, scaler_min, scaler_max, steps, state, update_date
+                FROM cammesa_db.hourly_lstm_state
+                WHERE region_code = """ + str(region_code) + """ AND model_id = '""" + HOURLY_MODEL_ID + """'"""
+    process_ok, error_txt, df_state = pg_select_to_pandas(cursor, sql_query, verbose=False)
+    if not process_ok:
+        return process_ok, 'ERROR stateful_lstm_forecast calling subprocess: ' + error_txt, Y_
+    replay = True
+    if df_state.shape[0] > 0 and df_state.model_hash[0].strip() == model_hash:
+        state_timestamp = df_state.state_timestamp[0]
+        k = int((last_timestamp - state_timestamp) / pd.Timedelta(hours=1))
+        if 0 <= k and df_state.steps[0] + k <= max_steps:
+            sql_query = """SELECT timestamp, hourly_demand
+                        FROM cammesa_db.hourly_demand
+                        WHERE region_code = """ + str(region_code) + """
+                        AND timestamp > '""" + state_timestamp.strftime('%Y-%m-%d %H:%M') + """'
+                        AND timestamp <= '""" + last_timestamp.strftime('%Y-%m-%d %H:%M') + """'
+                        ORDER BY timestamp"""
+            process_ok, error_txt, df_new = pg_select_to_pandas(cursor, sql_query, verbose=False)
+            if not process_ok:
+                return process_ok, 'ERROR stateful_lstm_forecast calling subprocess: ' + error_txt, Y_
+            # Any missing hour in between --> replay
+            replay = df_new.shape[0] != k
+        if not replay:
+            # Hours already in the state (since the last replay, with its window) revised after the state was saved -->
+            # replay, the state still holds the old values
+            sql_query = """SELECT COUNT(*) AS n_revised
+                        FROM cammesa_db.hourly_demand
+                        WHERE region_code = """ + str(region_code) + """
+                        AND timestamp >= '""" + (state_timestamp + timedelta(hours=-(int(df_state.steps[0]) + n_lookback))).strftime('%Y-%m-%d %H:%M') + """'
+                        AND timestamp <= '""" + state_timestamp.strftime('%Y-%m-%d %H:%M') + """'
+                        AND update_date > '""" + pd.Timestamp(df_state.update_date[0]).strftime('%Y-%m-%d %H:%M:%S.%f') + """'"""
+            process_ok, error_txt, df_revised = pg_select_to_pandas(cursor, sql_query, verbose=False)
+            if not process_ok:
+                return process_ok, 'ERROR stateful_lstm_forecast calling subprocess: ' + error_txt, Y_
+            replay = df_revised.n_revised[0] > 0
+    if not replay:
+        scaler_min, scaler_max, steps = df_state.scaler_min[0], df_state.scaler_max[0], int(df_state.steps[0]) + k
+        arrays = np.load(io.BytesIO(bytes(df_state.state[0])))
+        states = [[tf.constant(arrays['h_' + str(i)]), tf.constant(arrays['c_' + str(i)])] for i in range(len(arrays.files) // 2)]
+        out = tf.constant(arrays['out'])
+        if k > 0:
+            xs = (df_new.hourly_demand.to_numpy(dtype=float) - scaler_min) / (scaler_max - scaler_min)
+            out, states = lstm_advance(model, xs, states)
+        if verbose:
+            print('INFO stateful_lstm_forecast - State advanced ' + str(k) + ' hours to ' + last_timestamp.strftime('%Y-%m-%d %H:%M'))
+    else:
+        # Same window as the full (windowed) forecast
+        sql_query = """SELECT timestamp, hourly_demand
+                    FROM cammesa_db.hourly_demand
+                    WHERE region_code = """ + str(region_code) + """
+                    AND timestamp >= '""" + (last_timestamp+timedelta(hours=-n_lookback)).strftime('%Y-%m-%d %H:%M') + """'
+                    AND timestamp <= '""" + last_timestamp.strftime('%Y-%m-%d %H:%M') + """'
+                    ORDER BY timestamp"""
+        process_ok, error_txt, df_lookback = pg_select_to_pandas(cursor, sql_query, verbose=False)
+        if not process_ok:
+            return process_ok, 'ERROR stateful_lstm_forecast calling subprocess: ' + error_txt, Y_
+        process_ok, error_txt, values = fill_hourly_window(df_lookback, last_timestamp + timedelta(hours=-n_lookback)
+                                                          , last_timestamp, max_missing_hours)
+        if not process_ok:
+            return process_ok, 'ERROR stateful_lstm_forecast. ' + error_txt, Y_
+        scaler_min, scaler_max, steps = values.min(), values.max(), 0
+        xs = (values[-n_lookback:] - scaler_min) / (scaler_max - scaler_min)
+        out, states = lstm_advance(model, xs, lstm_initial_states(model))
+        if verbose:
+            print('INFO stateful_lstm_forecast - Window of ' + str(n_lookback) + ' hours replayed to ' +\
+                  last_timestamp.strftime('%Y-%m-%d %H:%M'))
+    Y_ = lstm_head(model, out).reshape(-1, 1) * (scaler_max - scaler_min) + scaler_min
+    # Save the new state
+    arrays = {'out': np.asarray(out)}
+    for i, (h, c) in enumerate(states):
+        arrays['h_' + str(i)], arrays['c_' + str(i)] = np.asarray(h), np.asarray(c)
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    upsert_user = getpass.getuser()
+    sql = """INSERT INTO cammesa_db.hourly_lstm_state
+            (region_code, model_id, state_timestamp, model_hash, scaler_min, scaler_max, steps, state
+            , create_user, create_date, update_user, update_date) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (region_code, model_id) DO UPDATE
+            SET state_timestamp=EXCLUDED.state_timestamp, model_hash=EXCLUDED.model_hash, scaler_min=EXCLUDED.scaler_min
+            , scaler_max=EXCLUDED.scaler_max, steps=EXCLUDED.steps, state=EXCLUDED.state
+            , update_user=EXCLUDED.update_user, update_date=EXCLUDED.update_date;
+            """
+    try:
+        cursor.execute(sql, (region_code, HOURLY_MODEL_ID, last_timestamp.to_pydatetime(), model_hash, float(scaler_min)
+                             , float(scaler_max), steps, psycopg2.Binary(buffer.getvalue()), upsert_user, datetime.now()
+                             , upsert_user, datetime.now()))
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        process_ok = False
+        error_txt = 'ERROR stateful_lstm_forecast saving state. ' + ' '.join(formatted_lines)
+    return process_ok, error_txt, Y_
+
+def _calculate_hourly_demand_forecast(timestamp_max, database, host, user, password, port, n_lookback=48, n_forecast=24
+                                      , n_samples=100, stateful=False, max_missing_hours=2, verbose=True):
+    """ Forecast of the next n_forecast hours with the pre trained LSTM, from the last n_lookback hours of history. Upserts
+        cammesa_db.hourly_demand_forecast with the point forecast and P10/P50/P90 from n_samples samples (n_samples=0:
+        point forecast only): MC dropout if the model has dropout, else bootstrap of its recent errors (bootstrap_quantiles,
+        NULL quantiles until there are enough errors).
+        stateful=True: the LSTM state of the previous run is advanced with the new hours (see stateful_lstm_forecast).
+        MC dropout needs the whole window, so the bootstrap is used in this mode.
+        Up to max_missing_hours missing hours of the window (see cammesa_db.hourly_demand_gaps) are interpolated.
+    """
     import os
     print('WORKDIR: ' + os.getcwd())
     error_txt = ''
@@ -294,109 +979,468 @@ def _calculate_hourly_demand_forecast(timestamp_max, database, host, user, passw
     if not process_ok:
         if verbose:
             print('ERROR _calculate_hourly_demand_forecast calling subprocess: ' + error_txt)
+        return process_ok, error_txt
+    # [1] Get last record with history data. The watermark is enough unless we are re processing the past:
+    process_ok, error_txt, watermark = get_watermark('hourly_demand_1002', cursor)
+    if process_ok and watermark is not None and watermark < timestamp_max.replace(tzinfo=None):
+        df_last_time = pd.DataFrame(data=[[watermark]], columns=['max_timestamp'])
     else:
-        # [1] Get last record with history data: 
         sql_query = """SELECT MAX(timestamp) AS max_timestamp
                     FROM cammesa_db.hourly_demand 
                     WHERE timestamp < '""" + timestamp_max.strftime('%Y-%m-%d %H:%M') + """'"""
         process_ok, error_txt, df_last_time = pg_select_to_pandas(cursor, sql_query, verbose=True)
+    if not process_ok:
+        if verbose:
+            print('ERROR _calculate_hourly_demand_forecast calling subprocess: ' + error_txt)
+        cnxn.close()
+        return process_ok, error_txt
+    last_timestamp = df_last_time.max_timestamp[0]
+    if verbose:
+        print('INFO _calculate_hourly_demand_forecast forecast timestamp start: ' +\
+                                                                         timestamp_max.strftime('%Y-%m-%d %H:%M'))
+        print('INFO _calculate_hourly_demand_forecast hist timestamp max: ' + last_timestamp.strftime('%Y-%m-%d %H:%M'))
+    # Missing hours in the lookback window: indexed lookup on the gap index. A few are interpolated (fill_hourly_window)
+    window_start = last_timestamp + timedelta(hours=-n_lookback)
+    process_ok, error_txt, df_gaps = get_hourly_gaps(1002, window_start, last_timestamp, cursor)
+    if process_ok and df_gaps.shape[0] > 0:
+        n_missing = sum((min(pd.Timestamp(r.gap_end), pd.Timestamp(last_timestamp)) - max(pd.Timestamp(r.gap_start), pd.Timestamp(window_start)))
+                        // pd.Timedelta(hours=1) + 1 for r in df_gaps.itertuples())
+        if n_missing > max_missing_hours:
+            process_ok = False
+            error_txt = 'ERROR _calculate_hourly_demand_forecast: ' + str(n_missing) + ' missing hours in the last ' + str(n_lookback) +\
+                ' hours (tolerance: ' + str(max_missing_hours) + '): ' +\
+                ', '.join([r.gap_start.strftime('%Y-%m-%d %H:%M') + ' to ' + r.gap_end.strftime('%Y-%m-%d %H:%M')
+                           for r in df_gaps.itertuples()]) + '. Run _backfill_hourly_gaps.'
+    if not process_ok:
+        if verbose:
+            print(error_txt)
+        cnxn.close()
+        return process_ok, error_txt
+    # Holidays of the forecasted hours. Resolved before the stateful step: get_holidays commits (or rolls back) when it
+    # refreshes a year, and the LSTM state must only be committed together with the forecast.
+    forecast_timestamps = pd.date_range(start=last_timestamp + pd.Timedelta(hours=1), freq='1H', periods=n_forecast)
+    process_ok, error_txt, holidays = get_holidays(forecast_timestamps.year.unique().tolist(), cnxn, cursor, verbose=False)
+    if not process_ok:
+        if verbose:
+            print('ERROR _calculate_hourly_demand_forecast calling submodule: '+error_txt)
+        cnxn.close()
+        return process_ok, error_txt
+    # Load pre-trained model
+    model = load_model(HOURLY_MODEL_FILE)
+    Y_quantiles = None
+    if stateful:
+        process_ok, error_txt, Y_ = stateful_lstm_forecast(model, files_sha1([HOURLY_MODEL_FILE]), last_timestamp, n_lookback
+                                                           , cnxn, cursor, region_code=1002
+                                                           , max_missing_hours=max_missing_hours, verbose=verbose)
         if not process_ok:
             if verbose:
-                print('ERROR nombre_del_modulo calling subprocess: ' + error_txt)
-                cnxn.close()
-        else:
-            last_timestamp = df_last_time.max_timestamp[0]
-            if verbose:
-                print('INFO _calculate_hourly_demand_forecast forecast timestamp start: ' +\
-                                                                                 timestamp_max.strftime('%Y-%m-%d %H:%M'))
-                print('INFO _calculate_hourly_demand_forecast hist timestamp max: ' + last_timestamp.strftime('%Y-%m-%d %H:%M'))
-            # [1] Get last n_lookback hours --> to predict next n_forecast hour demand
-            sql_query = """SELECT timestamp, hourly_demand, hourly_temp, day_of_week, is_holiday 
-                        FROM cammesa_db.hourly_demand 
-                        WHERE timestamp >= '""" + (last_timestamp+timedelta(hours=-n_lookback)).strftime('%Y-%m-%d %H:%M') +"'" +\
-                    """AND timestamp <= '""" + last_timestamp.strftime('%Y-%m-%d %H:%M') +"'"+\
-                    """ORDER BY timestamp"""
+                print(error_txt)
+            cnxn.rollback()
+            cnxn.close()
+            return process_ok, error_txt
+    else:
+        # [1] Get last n_lookback hours --> to predict next n_forecast hour demand
+        sql_query = """SELECT timestamp, hourly_demand, hourly_temp, day_of_week, is_holiday 
+                    FROM cammesa_db.hourly_demand 
+                    WHERE timestamp >= '""" + (last_timestamp+timedelta(hours=-n_lookback)).strftime('%Y-%m-%d %H:%M') +"'" +\
+                """AND timestamp <= '""" + last_timestamp.strftime('%Y-%m-%d %H:%M') +"'"+\
+                """ORDER BY timestamp"""
         process_ok, error_txt, df_lookback = pg_select_to_pandas(cursor, sql_query, verbose=True)
         if not process_ok:
             if verbose:
-                print('ERROR nombre_del_modulo calling subprocess: ' + error_txt)
-                cnxn.close()
-        elif df_lookback.shape[0] < n_lookback:
+                print('ERROR _calculate_hourly_demand_forecast calling subprocess: ' + error_txt)
+            cnxn.close()
+            return process_ok, error_txt
+        process_ok, error_txt, values = fill_hourly_window(df_lookback, window_start, last_timestamp, max_missing_hours)
+        if not process_ok:
             if verbose:
-                print('ERROR _calculate_hourly_demand_forecast: retrieved less records than requiered for calculation ' +\
-                    'n_lookback='+str(n_lookback) + ' retrieved: '+str(df_lookback.shape[0]))
-                cnxn.close()
-        else:
-            # [2] Prepare Data. Normalize, re shape
-            # We are not interested in the date, given that each observation is separated by the same interval (hourly) 
-            # We build an univariate dataset:
-            df_hist_univar = df_lookback[['hourly_demand']]
-            # LSTMs are sensitive to the scale of the input data, specifically when the sigmoid (default) or tanh activation functions are used. 
-            # It can be a good practice to rescale the data to the range of 0-to-1, also called normalizing.
-            scaler = MinMaxScaler(feature_range=(0, 1))
-            y = scaler.fit_transform(df_hist_univar)
-            # [3] Generate forecasts
-            X_ = y[- n_lookback:]  # last available input sequence
-            X_ = X_.reshape(1, n_lookback, 1)
-            # Load pre-trained model /opt/airflow/dags
-            #model = load_model('/opt/airflow/dags/lstm_24_model.h5')
-            model = load_model('/home/colmo/airflow/dags/lstm_24_model.h5')
-            Y_ = model.predict(X_).reshape(-1, 1)
-            Y_ = scaler.inverse_transform(Y_)
-            # [4] Upsert data onto database
-            df_future = pd.DataFrame(columns=['timestamp', 'hourly_demand_forecast'])
-            df_future['timestamp'] = pd.date_range(start=df_lookback['timestamp'].iloc[-1] + pd.Timedelta(hours=1)
-                                                , freq='1H', periods=n_forecast)
-            df_future['hourly_demand_forecast'] = Y_.flatten()
+                print(error_txt)
+            cnxn.close()
+            return process_ok, error_txt
+        # [2] Prepare Data. Normalize, re shape
+        # We are not interested in the date, given that each observation is separated by the same interval (hourly) 
+        # We build an univariate dataset:
+        df_hist_univar = values.reshape(-1, 1)
+        # LSTMs are sensitive to the scale of the input data, specifically when the sigmoid (default) or tanh activation functions are used. 
+        # It can be a good practice to rescale the data to the range of 0-to-1, also called normalizing.
+        scaler = MinMaxScaler(feature_range=(0, 1))
+        y = scaler.fit_transform(df_hist_univar)
+        # [3] Generate forecasts
+        X_ = y[- n_lookback:]  # last available input sequence
+        X_ = X_.reshape(1, n_lookback, 1)
+        Y_ = model.predict(X_).reshape(-1, 1)
+        Y_ = scaler.inverse_transform(Y_)
+        if n_samples > 0 and model_has_dropout(model):
+            Y_quantiles = forecast_quantiles(model, X_, scaler, n_samples=n_samples)
+    if n_samples > 0 and Y_quantiles is None:
+        process_ok, error_txt, Y_quantiles = bootstrap_quantiles(Y_, last_timestamp, cursor, region_code=1002
+                                                                 , model_id=HOURLY_MODEL_ID, n_samples=n_samples)
+        if not process_ok:
             if verbose:
-                print('INFO _calculate_hourly_demand_forecast: forecast calculated for next '+str(n_forecast)+' hours. Since: '+\
-                    last_timestamp.strftime('%Y-%m-%d %H:%M'))
-                df_future.hourly_demand_forecast = df_future.hourly_demand_forecast.astype(int)
-                df_future['hourly_temp_forecast'] = np.nan
-                df_future['day_of_week'] = df_future.timestamp.dt.dayofweek
-                for index, row in df_future.iterrows():
-                    process_ok, error_txt, is_a_holiday = is_holiday(row['timestamp'], verbose=False)
-                    if not process_ok:
-                        if verbose:
-                            print('ERROR _calculate_hourly_demand_forecast calling submodule: '+error_txt)
-                        cnxn.close()
-                        break
-                    else:
-                        df_future['is_holiday'] = is_a_holiday
-                if process_ok:
-                    upsert_user=getpass.getuser()
-                    tup = [tuple(np.append(np.append([1002], r), [upsert_user, datetime.now(), upsert_user, datetime.now()])) \
-                                for r in df_future.to_numpy()]
-                    sql = """INSERT INTO cammesa_db.hourly_demand_forecast
-                            (region_code, timestamp, hourly_demand_forecast, hourly_temp_forecast, day_of_week, is_holiday
-                            , create_user, create_date, update_user, update_date) VALUES %s 
-                            ON CONFLICT (region_code, timestamp) DO UPDATE
-                            SET hourly_demand_forecast=EXCLUDED.hourly_demand_forecast
-                            , hourly_temp_forecast=EXCLUDED.hourly_temp_forecast
-                            , day_of_week=EXCLUDED.day_of_week
-                            , is_holiday=EXCLUDED.is_holiday, update_user=EXCLUDED.update_user, update_date=EXCLUDED.update_date;
-                            """
-                    execute_values(cursor, sql, tup)
-                    cnxn.commit()
-                    print('INFO _calculate_hourly_demand_forecast - ' + str(len(tup)) + ' records were upserted. Table cammesa_db.hourly_demand_forecast.')
+                print(error_txt)
+            cnxn.rollback()
+            cnxn.close()
+            return process_ok, error_txt
+        if Y_quantiles is None and verbose:
+            print('INFO _calculate_hourly_demand_forecast: not enough recent errors to bootstrap. Quantiles saved as NULL.')
+    # [4] Upsert data onto database
+    df_future = pd.DataFrame(columns=['timestamp', 'hourly_demand_forecast'])
+    df_future['timestamp'] = forecast_timestamps
+    df_future['hourly_demand_forecast'] = Y_.flatten()
+    if verbose:
+        print('INFO _calculate_hourly_demand_forecast: forecast calculated for next '+str(n_forecast)+' hours. Since: '+\
+            last_timestamp.strftime('%Y-%m-%d %H:%M'))
+    df_future.hourly_demand_forecast = df_future.hourly_demand_forecast.astype(int)
+    df_future['hourly_temp_forecast'] = np.nan
+    df_future['day_of_week'] = df_future.timestamp.dt.dayofweek
+    df_future['is_holiday'] = df_future.timestamp.dt.date.isin(holidays).astype(int)
+    # Model and last hour of history used: needed to measure the accuracy by model and horizon.
+    df_future['model_id'] = HOURLY_MODEL_ID
+    df_future['forecast_base_timestamp'] = last_timestamp
+    for i, col in enumerate(['hourly_demand_p10', 'hourly_demand_p50', 'hourly_demand_p90']):
+        df_future[col] = Y_quantiles[i].astype(int) if Y_quantiles is not None else None
+    upsert_user=getpass.getuser()
+    tup = [tuple(np.append(np.append([1002], r), [upsert_user, datetime.now(), upsert_user, datetime.now()])) \
+                for r in df_future.to_numpy()]
+    sql = """INSERT INTO cammesa_db.hourly_demand_forecast
+            (region_code, timestamp, hourly_demand_forecast, hourly_temp_forecast, day_of_week, is_holiday
+            , model_id, forecast_base_timestamp, hourly_demand_p10, hourly_demand_p50, hourly_demand_p90
+            , create_user, create_date, update_user, update_date) VALUES %s 
+            ON CONFLICT (region_code, timestamp) DO UPDATE
+            SET hourly_demand_forecast=EXCLUDED.hourly_demand_forecast
+            , hourly_temp_forecast=EXCLUDED.hourly_temp_forecast
+            , day_of_week=EXCLUDED.day_of_week
+            , is_holiday=EXCLUDED.is_holiday
+            , model_id=EXCLUDED.model_id, forecast_base_timestamp=EXCLUDED.forecast_base_timestamp
+            , hourly_demand_p10=EXCLUDED.hourly_demand_p10, hourly_demand_p50=EXCLUDED.hourly_demand_p50
+            , hourly_demand_p90=EXCLUDED.hourly_demand_p90
+            , update_user=EXCLUDED.update_user, update_date=EXCLUDED.update_date;
+            """
+    execute_values(cursor, sql, tup)
+    # hourly_demand_forecast keeps only the last forecast of each hour: every forecast is also kept by its base hour, to
+    # measure the accuracy by horizon (_monitor_forecast_accuracy)
+    sql = """INSERT INTO cammesa_db.hourly_demand_forecast_history
+            (region_code, timestamp, forecast_base_timestamp, model_id, hourly_demand_forecast, hourly_demand_p10
+            , hourly_demand_p50, hourly_demand_p90, create_user, create_date, update_user, update_date)
+            SELECT region_code, timestamp, forecast_base_timestamp, model_id, hourly_demand_forecast, hourly_demand_p10
+            , hourly_demand_p50, hourly_demand_p90, %(user)s, now(), %(user)s, now()
+            FROM cammesa_db.hourly_demand_forecast
+            WHERE region_code = 1002 AND timestamp > %(base)s AND forecast_base_timestamp = %(base)s AND model_id = %(model_id)s
+            ON CONFLICT (region_code, timestamp, forecast_base_timestamp, model_id) DO UPDATE
+            SET hourly_demand_forecast=EXCLUDED.hourly_demand_forecast, hourly_demand_p10=EXCLUDED.hourly_demand_p10
+            , hourly_demand_p50=EXCLUDED.hourly_demand_p50, hourly_demand_p90=EXCLUDED.hourly_demand_p90
+            , update_user=EXCLUDED.update_user, update_date=EXCLUDED.update_date;
+            """
+    cursor.execute(sql, {'user': upsert_user, 'base': pd.Timestamp(last_timestamp).to_pydatetime(), 'model_id': HOURLY_MODEL_ID})
+    # Commits the forecast together with its history and the LSTM state (stateful mode)
+    cnxn.commit()
+    print('INFO _calculate_hourly_demand_forecast - ' + str(len(tup)) + ' records were upserted. Table cammesa_db.hourly_demand_forecast' +\
+          ' and cammesa_db.hourly_demand_forecast_history.')
+    cnxn.close()
     return process_ok, error_txt
 
-def process_demand(file, month):
+def _backfill_hourly_gaps(database, host, user, password, port, max_days=7, verbose=True):
+    """ Asks the API again for the days with missing hours of cammesa_db.hourly_demand_gaps (most recent first, up to
+        max_days days) through _get_hourly_demand, which updates the gap index. A day d is requested as d+1 00:00, so the
+        whole day (with its 00:00 hour, returned with d) is loaded. Hours that the API never returns remain as gaps. Days
+        whose missing hours are all on cammesa_db.hourly_demand_rejected are not requested.
+    """
+    process_ok, error_txt, cnxn, cursor = build_postgres_cnxn(database=database, host=host, user=user, password=password
+                                        , port=port, verbose=verbose)
+    if not process_ok:
+        if verbose:
+            print('ERROR _backfill_hourly_gaps building postgres cnxn: ' + error_txt)
+        return process_ok
+    process_ok, error_txt, df_gaps = get_hourly_gaps(1002, None, None, cursor)
+    if process_ok:
+        process_ok, error_txt, df_rejected = pg_select_to_pandas(cursor, """SELECT timestamp
+                                                                 FROM cammesa_db.hourly_demand_rejected
+                                                                 WHERE region_code = 1002""", verbose=False)
+    cnxn.close()
+    if not process_ok:
+        print('ERROR _backfill_hourly_gaps - ' + error_txt)
+        return process_ok
+    rejected = pd.DatetimeIndex(pd.to_datetime(df_rejected.timestamp))
+    days = []
+    for r in df_gaps.itertuples():
+        gap_start, gap_end = pd.Timestamp(r.gap_start), pd.Timestamp(r.gap_end)
+        # Hour h belongs to the API day of h - 1 hour
+        for day in pd.date_range(start=(gap_end - pd.Timedelta(hours=1)).normalize()
+                                 , end=(gap_start - pd.Timedelta(hours=1)).normalize(), freq='-1D'):
+            if len(days) >= max_days:
+                break
+            # Days whose missing hours were all rejected by the quality rules would get the same values again
+            hours = pd.date_range(start=max(day + pd.Timedelta(hours=1), gap_start), end=min(day + pd.Timedelta(days=1), gap_end)
+                                  , freq='1H')
+            if day not in days and not hours.isin(rejected).all():
+                days.append(day)
+    if verbose:
+        print('INFO _backfill_hourly_gaps - ' + str(df_gaps.shape[0]) + ' missing hour ranges. Days to request: ' +\
+              ', '.join([day.strftime('%Y-%m-%d') for day in days]))
+    for day in days:
+        if not _get_hourly_demand((day + pd.Timedelta(days=1)).to_pydatetime(), database=database, host=host, user=user
+                                  , password=password, port=port, verbose=verbose):
+            process_ok = False
+    return process_ok
+
+def _monitor_forecast_accuracy(date, database, host, user, password, port, frequency='H', region_code=1002, verbose=True):
+    """ Adds the forecast errors of the actuals arrived since the last run to the running aggregates of
+        cammesa_db.forecast_accuracy (by frequency, region, model and horizon). Read MAPE and bias from
+        cammesa_db.forecast_accuracy_v.
+        frequency='H': cammesa_db.hourly_demand vs every forecast of cammesa_db.hourly_demand_forecast_history for
+        region_code (one per base hour: horizon 1 to n_forecast). Run after _get_hourly_demand.
+        frequency='M': national monthly_demand vs the monthly experiments (experiments_detail.forecast_value), region 0.
+        Only actuals after the 'forecast_accuracy_<H|M>_<region>' watermark (and up to the ingestion watermark) are read, both
+        tables are accessed by their primary keys. The watermark is advanced in the same transaction, so a re run does not
+        count an actual twice.
+    """
+    error_txt = ''
+    process_ok, error_txt, cnxn, cursor = build_postgres_cnxn(database=database, host=host, user=user, password=password
+                                        , port=port, verbose=verbose)
+    if not process_ok:
+        if verbose:
+            print('ERROR _monitor_forecast_accuracy building postgres cnxn: ' + error_txt)
+        return process_ok
+    if frequency == 'M':
+        region_code = 0
+        actuals_source = 'monthly_bases'
+    else:
+        actuals_source = 'hourly_demand_' + str(region_code)
+    source = 'forecast_accuracy_' + frequency + '_' + str(region_code)
+    process_ok, error_txt, watermark_from = get_watermark(source, cursor)
+    if process_ok:
+        process_ok, error_txt, watermark_to = get_watermark(actuals_source, cursor)
+    if not process_ok:
+        if verbose:
+            print('ERROR _monitor_forecast_accuracy - ' + error_txt)
+        cnxn.close()
+        return process_ok
+    if watermark_to is None or (watermark_from is not None and watermark_from >= watermark_to):
+        if verbose:
+            print('INFO _monitor_forecast_accuracy - No new actuals since ' + str(watermark_from) + '. Source: ' + source)
+        cnxn.close()
+        return process_ok
+    if watermark_from is None:
+        watermark_from = datetime(1900, 1, 1)
+    upsert_user = getpass.getuser()
+    if frequency == 'M':
+        sql_select = """WITH actual AS (
+                        SELECT month, SUM(monthly_demand_mwh) AS hist_value
+                        FROM cammesa_db.monthly_demand
+                        WHERE month > %(from)s AND month <= %(to)s
+                        GROUP BY month)
+                    , errors AS (
+                        SELECT e.model_id
+                        , ((EXTRACT(YEAR FROM a.month) - EXTRACT(YEAR FROM e.experiment_date)) * 12 +
+                            EXTRACT(MONTH FROM a.month) - EXTRACT(MONTH FROM e.experiment_date))::int AS horizon
+                        , ed.forecast_value - a.hist_value AS error, a.hist_value AS actual, a.month AS timestamp
+                        FROM actual a
+                        JOIN cammesa_db.experiments_detail ed ON ed.month = a.month
+                        JOIN cammesa_db.experiments e ON e.experiment_id = ed.experiment_id
+                        WHERE ed.forecast_value IS NOT NULL AND e.experiment_date < a.month AND a.hist_value > 0)"""
+    else:
+        sql_select = """WITH errors AS (
+                        SELECT f.model_id
+                        , (EXTRACT(EPOCH FROM (f.timestamp - f.forecast_base_timestamp)) / 3600)::int AS horizon
+                        , (f.hourly_demand_forecast - d.hourly_demand)::float AS error, d.hourly_demand::float AS actual
+                        , d.timestamp
+                        FROM cammesa_db.hourly_demand d
+                        JOIN cammesa_db.hourly_demand_forecast_history f ON f.region_code = d.region_code AND f.timestamp = d.timestamp
+                        WHERE d.region_code = %(region_code)s AND d.timestamp > %(from)s AND d.timestamp <= %(to)s
+                        AND d.hourly_demand > 0)"""
+    sql = sql_select + """
+            INSERT INTO cammesa_db.forecast_accuracy AS t
+            (frequency, region_code, model_id, horizon, n, sum_ape, sum_error, sum_abs_error, sum_actual, last_timestamp
+            , create_user, create_date, update_user, update_date)
+            SELECT %(frequency)s, %(region_code)s, model_id, horizon, COUNT(*), SUM(ABS(error) / actual), SUM(error)
+            , SUM(ABS(error)), SUM(actual), MAX(timestamp), %(user)s, now(), %(user)s, now()
+            FROM errors
+            GROUP BY model_id, horizon
+            ON CONFLICT (frequency, region_code, model_id, horizon) DO UPDATE
+            SET n=t.n+EXCLUDED.n, sum_ape=t.sum_ape+EXCLUDED.sum_ape, sum_error=t.sum_error+EXCLUDED.sum_error
+            , sum_abs_error=t.sum_abs_error+EXCLUDED.sum_abs_error, sum_actual=t.sum_actual+EXCLUDED.sum_actual
+            , last_timestamp=GREATEST(t.last_timestamp, EXCLUDED.last_timestamp)
+            , update_user=EXCLUDED.update_user, update_date=EXCLUDED.update_date;
+            """
+    try:
+        cursor.execute(sql, {'from': watermark_from, 'to': watermark_to, 'region_code': region_code, 'frequency': frequency
+                             , 'user': upsert_user})
+        n_groups = cursor.rowcount
+        bool_raise, error_txt = set_watermark(source, watermark_to, cursor)
+        if bool_raise:
+            raise ValueError(error_txt)
+        cnxn.commit()
+        if verbose:
+            print('INFO _monitor_forecast_accuracy - Actuals since ' + str(watermark_from) + ' to ' + str(watermark_to) +\
+                  ' added to ' + str(n_groups) + ' model/horizon aggregates. Table cammesa_db.forecast_accuracy.')
+    except Exception as err:
+        cnxn.rollback()
+        formatted_lines = traceback.format_exc().splitlines()
+        txt = ' '.join(formatted_lines)
+        process_ok = False
+        print('ERROR _monitor_forecast_accuracy - Error updating cammesa_db.forecast_accuracy.\n' + txt)
+    cnxn.close()
+    return process_ok
+
+# Layout of the sheets of the monthly workbooks: header row, columns to read (renamed for ease) and dtypes.
+# Text columns are read as str. Once the month is filtered, low cardinality columns become categories and integer columns
+# are downcast (see apply_sheet_schema). Measures stay float64: they are stored as double precision and a float32 round
+# trip would change the values upserted. Columns that get new values later on (agent_desc, agent_dem_type,
+# hidraulic_categ) are not categories.
+MONTHLY_SHEETS = {
+    'demand': {'sheet_name': 'DEMANDA', 'header': 23, 'usecols': 'A:L'
+        , 'names': ['year', 'month', 'agent_id', 'agent_desc', 'agent_dem_type', 'region_desc', 'prov_desc'
+                    , 'area_categ', 'demand_categ', 'tariff_desc', 'tariff_categ', 'monthly_demand_mwh']
+        , 'str_cols': ['agent_desc', 'region_desc', 'prov_desc', 'area_categ', 'demand_categ', 'tariff_desc', 'tariff_categ']
+        , 'category_cols': ['region_desc', 'prov_desc', 'area_categ', 'demand_categ', 'tariff_desc', 'tariff_categ']
+        , 'int_cols': ['year']},
+    'gen': {'sheet_name': 'GENERACION', 'header': 21, 'usecols': 'A:O'
+        , 'names': ['year', 'month', 'machine_code', 'central_id', 'agent_id', 'agent_desc', 'region_desc', 'prov_desc', 'pais'
+                    , 'machine_type', 'source_gen', 'technology', 'hidraulic_categ', 'region_categ', 'monthly_gen_mwh']
+        , 'str_cols': ['agent_desc', 'region_desc', 'machine_type', 'source_gen', 'technology', 'region_categ']
+        , 'category_cols': ['region_desc', 'prov_desc', 'machine_type', 'source_gen', 'technology', 'region_categ']
+        , 'int_cols': ['year']},
+    'prices': {'sheet_name': 'PRECIOS', 'header': 4},
+    # REGION and PROVINCIA are dropped by name, so columns are renamed after reading:
+    'fuels': {'sheet_name': 'COMBUSTIBLES', 'header': 21, 'usecols': 'A:M'
+        , 'category_cols': ['machine_type', 'source_gen', 'technology', 'combustible_type']
+        , 'int_cols': ['year']},
+    'avail': {'sheet_name': 'DISPONIBILIDAD x CENTRAL', 'header': 21, 'usecols': 'A:G'
+        , 'names': ['month', 'central_id', 'agent_id', 'agent_desc', 'technology_desc', 'technology', 'monthly_availability_factor']
+        , 'str_cols': ['agent_desc', 'technology_desc', 'technology']
+        , 'category_cols': ['technology', 'technology_desc']
+        , 'int_cols': ['year']},
+    'impo_expo': {'sheet_name': 'IMP-EXP', 'header': 27, 'usecols': 'A:E'
+        , 'names': ['year', 'month', 'pais', 'import_export_type', 'monthly_energy_mwh']
+        , 'str_cols': ['pais', 'import_export_type']
+        , 'category_cols': ['pais', 'import_export_type']
+        , 'int_cols': ['year']},
+}
+
+# Engines tried in order to read the workbooks. calamine (pandas >= 2.2, pip install python-calamine) is several times
+# faster than openpyxl on the big sheets; openpyxl (that pandas already opens read only) is the fallback.
+EXCEL_ENGINES = ['calamine', 'openpyxl']
+
+def read_monthly_sheet(file, sheet, engines=None):
+    """ Reads a sheet of a monthly workbook as described on MONTHLY_SHEETS[sheet]. Tries each one of engines (default
+        EXCEL_ENGINES) until one works, so a missing or failing fast engine falls back to the next one.
+    """
+    schema = MONTHLY_SHEETS[sheet]
+    dtype = {col: str for col in schema.get('str_cols', [])}
+    engines = engines if engines else EXCEL_ENGINES
+    for i, engine in enumerate(engines):
+        try:
+            return pd.read_excel(file, sheet_name=schema['sheet_name'], header=schema['header'], usecols=schema.get('usecols')
+                                , names=schema.get('names'), dtype=dtype if dtype else None, decimal=',', engine=engine)
+        except Exception as err:
+            if i == len(engines) - 1:
+                raise
+            print('WARNING read_monthly_sheet - engine ' + engine + ' failed reading ' + file + '. Trying ' + engines[i+1] +\
+                  '. ' + str(err))
+
+def benchmark_monthly_sheets(files, engines=None):
+    """ Parse time of each sheet of a monthly base with each engine. files as returned by monthly_base_files.
+        Returns a DataFrame with sheet, engine, seconds, rows and the engine speed up against the slowest one.
+    """
+    engines = engines if engines else EXCEL_ENGINES
+    results = []
+    for sheet, file in files.items():
+        for engine in engines:
+            start = datetime.now()
+            try:
+                rows = read_monthly_sheet(file, sheet, engines=[engine]).shape[0]
+            except Exception as err:
+                print('WARNING benchmark_monthly_sheets - ' + sheet + ' with engine ' + engine + ' failed: ' + str(err))
+                continue
+            results.append([sheet, engine, (datetime.now() - start).total_seconds(), rows])
+            print('INFO benchmark_monthly_sheets - ' + sheet + ' ' + engine + ': ' + str(results[-1][2]) + ' seconds.')
+    df_bench = pd.DataFrame(data=results, columns=['sheet', 'engine', 'seconds', 'rows'])
+    df_bench['speed_up'] = df_bench.groupby('sheet').seconds.transform('max') / df_bench.seconds
+    return df_bench
+
+def _parse_monthly_bases(data_path, bases, variant='schema'):
+    """ Parses the monthly bases one month at a time, as _get_monthly_data does, up to the rows that each upsert would
+        send (the database is not touched). variant: 'schema' (current pipeline), 'no_schema' (same, without categories
+        nor downcast: process_* with with_schema=False) or 'legacy' (the pipeline before MONTHLY_SHEETS, see
+        monthly_legacy). Returns the rows parsed and the largest memory (MB, deep) of the tables of a month.
+    """
+    import monthly_legacy
+    n_rows = 0
+    tables_mb = 0
+    for base in bases:
+        files = monthly_base_files(data_path, base)
+        if variant == 'legacy':
+            bool_raise, error_txt, tables = monthly_legacy.build_month_tables(files, base)
+        else:
+            frames = {}
+            bool_raise = False
+            for workbook, process_workbook in MONTHLY_WORKBOOKS.items():
+                workbook_raise, error_txt, frames[workbook] = process_workbook(files[workbook], base
+                                                                               , with_schema=(variant == 'schema'))
+                bool_raise = bool_raise or workbook_raise
+            if not bool_raise:
+                bool_raise, error_txt, tables = build_monthly_tables(frames)
+            del frames
+        if bool_raise:
+            print('WARNING _parse_monthly_bases - ' + base + ' not parsed. ' + error_txt)
+            continue
+        tables_mb = max(tables_mb, sum(df.memory_usage(deep=True).sum() for _, df in tables) / 2**20)
+        for table, df, primary_key_cols in tables:
+            cols, tup = monthly_legacy.upsert_rows(df) if variant == 'legacy' else upsert_rows(df)
+            n_rows += len(tup)
+            del tup
+        del tables
+    return n_rows, tables_mb
+
+def benchmark_monthly_memory(bases, data_path=None):
+    """ Peak RSS (MB) of parsing bases (e.g. the 12 months of a year, already downloaded) with the current pipeline, the
+        same without categories nor downcast, and the pipeline before MONTHLY_SHEETS (monthly_legacy). Each variant runs
+        in its own process (peak_rss_mb). Returns a DataFrame with variant, rows, tables_mb (largest month), peak_rss_mb
+        and peak_rss_mb over the baseline (imports only).
+    """
+    data_path = data_path if data_path else monthly_data_path()
+    baseline = peak_rss_mb(len, ([],))[1]
+    results = []
+    for variant in ['schema', 'no_schema', 'legacy']:
+        (rows, tables_mb), peak = peak_rss_mb(_parse_monthly_bases, (data_path, bases, variant))
+        results.append([variant, rows, tables_mb, peak, peak - baseline])
+        print('INFO benchmark_monthly_memory - ' + variant + ': ' + str(rows) + ' rows, tables ' + str(round(tables_mb, 1)) +\
+              ' MB, peak RSS ' + str(round(peak, 1)) + ' MB (baseline ' + str(round(baseline, 1)) + ' MB).')
+    return pd.DataFrame(data=results, columns=['variant', 'rows', 'tables_mb', 'peak_rss_mb', 'peak_rss_over_baseline_mb'])
+
+def apply_sheet_schema(df, sheet):
+    """ Low cardinality columns to category and integer columns downcast, as described on MONTHLY_SHEETS[sheet].
+    """
+    schema = MONTHLY_SHEETS[sheet]
+    for col in schema.get('category_cols', []):
+        df[col] = df[col].astype('category')
+    for col in schema.get('int_cols', []):
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+    return df
+
+def sha1_id(df, cols, length=10):
+    """ Id built with the sha1 of the concatenation of cols (stripped, lower case). The hash is calculated once for each
+        distinct combination instead of once per row.
+    """
+    keys = df[cols[0]].astype(str).str.strip().str.lower()
+    for col in cols[1:]:
+        keys = keys + df[col].astype(str).str.strip().str.lower()
+    ids = {key: hashlib.sha1(str.encode(key)).hexdigest()[:length] for key in keys.unique()}
+    return keys.map(ids)
+
+def process_demand(file, month, with_schema=True):
     bool_raise = False
     error_txt = ''
     df_demand = pd.DataFrame()
     try:
-        df_demand = pd.read_excel(file, sheet_name='DEMANDA', header=23, usecols='A:L', decimal=',')
-        # Rename columns for ease:
-        cols = ['year', 'month', 'agent_id', 'agent_desc', 'agent_dem_type', 'region_desc', 'prov_desc'
-                , 'area_categ', 'demand_categ', 'tariff_desc', 'tariff_categ', 'monthly_demand_mwh']
-        df_demand.columns = cols
+        df_demand = read_monthly_sheet(file, 'demand')
         df_demand = df_demand[df_demand.month==month+'-01']
         # There are agents with leading o trailing spaces on desc, those spaces are removed to avoid build distinc ids on
         # master table
         df_demand['agent_desc'] = df_demand.agent_desc.str.strip()
-        df_demand['tariff_id'] = df_demand.apply(lambda x: 
-                hashlib.sha1(str.encode(x.tariff_desc.strip().lower()+x.tariff_categ.strip().lower())).hexdigest()[:10], axis=1)
+        df_demand['tariff_id'] = sha1_id(df_demand, ['tariff_desc', 'tariff_categ'])
+        if with_schema:
+            df_demand = apply_sheet_schema(df_demand, 'demand')
         df_demand.sort_values(by=['month', 'agent_id'], inplace=True)
         df_demand.reset_index(drop=True, inplace=True)
     except Exception as err:
@@ -406,14 +1450,12 @@ def process_demand(file, month):
         error_txt = 'process_demand - Error retrieving data from Excel: ' +  file + '\n' + txt
     return bool_raise, error_txt, df_demand
 
-def process_gen(file, month):
+def process_gen(file, month, with_schema=True):
     bool_raise = False
     error_txt = ''
+    df_gen = pd.DataFrame()
     try:
-        df_gen = pd.read_excel(file, sheet_name='GENERACION', header=21, usecols='A:O', decimal=',')
-        cols = ['year', 'month', 'machine_code', 'central_id', 'agent_id', 'agent_desc', 'region_desc', 'prov_desc', 'pais'
-                , 'machine_type', 'source_gen', 'technology', 'hidraulic_categ', 'region_categ', 'monthly_gen_mwh']
-        df_gen.columns = cols
+        df_gen = read_monthly_sheet(file, 'gen')
         df_gen = df_gen[df_gen.month==month+'-01']
 
         df_gen['agent_id'] = df_gen.agent_id.str.strip()
@@ -427,8 +1469,9 @@ def process_gen(file, month):
         df_gen.sort_values(by=['month', 'machine_code'], inplace=True)
         df_gen.reset_index(drop=True, inplace=True)
 
-        df_gen['machine_id'] = df_gen.apply(lambda x: 
-            hashlib.sha1(str.encode(x.machine_code.strip().lower()+x.machine_type.strip().lower()+x.technology.strip().lower())).hexdigest()[:10], axis=1)
+        df_gen['machine_id'] = sha1_id(df_gen, ['machine_code', 'machine_type', 'technology'])
+        if with_schema:
+            df_gen = apply_sheet_schema(df_gen, 'gen')
     except Exception as err:
         formatted_lines = traceback.format_exc().splitlines()
         txt = ' '.join(formatted_lines)
@@ -436,11 +1479,12 @@ def process_gen(file, month):
         error_txt = 'process_gen - Error retrieving data from Excel: ' +  file + '\n' + txt
     return bool_raise, error_txt, df_gen
 
-def process_prices(file, month):
+def process_prices(file, month, with_schema=True):
     bool_raise = False
     error_txt = ''
+    df_precios = pd.DataFrame()
     try:
-        df_precios = pd.read_excel(file, sheet_name='PRECIOS', header=4, decimal=',') #, usecols='A:CE'
+        df_precios = read_monthly_sheet(file, 'prices')
         df_precios.drop(columns=['COMPONENTES GENERALES'], inplace=True)
         df_precios.set_index(keys=['DETALLE'], inplace=True)
         df_precios = df_precios.T
@@ -470,11 +1514,12 @@ def process_prices(file, month):
         error_txt = 'process_prices - Error retrieving data from Excel: ' +  file + '\n' + txt
     return bool_raise, error_txt, df_precios
 
-def process_fuels(file, month):
+def process_fuels(file, month, with_schema=True):
     bool_raise = False
     error_txt = ''
+    df_fuels = pd.DataFrame()
     try:
-        df_fuels = pd.read_excel(file, sheet_name='COMBUSTIBLES', header=21, usecols='A:M', decimal=',')
+        df_fuels = read_monthly_sheet(file, 'fuels')
         df_fuels.drop(columns=['REGION', 'PROVINCIA'], inplace=True)
 
         cols = ['year', 'month', 'machine_code', 'central_id', 'agent_id', 'agent_desc', 'machine_type', 'source_gen', 'technology'
@@ -489,8 +1534,9 @@ def process_fuels(file, month):
         df_fuels.sort_values(by=['month', 'machine_code'], inplace=True)
         df_fuels.reset_index(drop=True, inplace=True)
 
-        df_fuels['machine_id'] = df_fuels.apply(lambda x: 
-            hashlib.sha1(str.encode(x.machine_code.strip().lower()+x.machine_type.strip().lower()+x.technology.strip().lower())).hexdigest()[:10], axis=1)
+        df_fuels['machine_id'] = sha1_id(df_fuels, ['machine_code', 'machine_type', 'technology'])
+        if with_schema:
+            df_fuels = apply_sheet_schema(df_fuels, 'fuels')
     except Exception as err:
         formatted_lines = traceback.format_exc().splitlines()
         txt = ' '.join(formatted_lines)
@@ -498,18 +1544,19 @@ def process_fuels(file, month):
         error_txt = 'process_fuels - Error retrieving data from Excel: ' +  file + '\n' + txt
     return bool_raise, error_txt, df_fuels
 
-def process_avail(file, month):
+def process_avail(file, month, with_schema=True):
     bool_raise = False
     error_txt = ''
+    df_availability = pd.DataFrame()
     try:
-        df_availability = pd.read_excel(file, sheet_name='DISPONIBILIDAD x CENTRAL', header=21, usecols='A:G', decimal=',')
-        cols = ['month', 'central_id', 'agent_id', 'agent_desc', 'technology_desc', 'technology', 'monthly_availability_factor']
-        df_availability.columns = cols
+        df_availability = read_monthly_sheet(file, 'avail')
         df_availability = df_availability[df_availability.month==month+'-01']
 
         df_availability['agent_id'] = df_availability.agent_id.str.strip()
         df_availability['central_id'] = df_availability.central_id.str.strip()
         df_availability['year'] = df_availability.month.dt.year
+        if with_schema:
+            df_availability = apply_sheet_schema(df_availability, 'avail')
 
         df_availability.sort_values(by=['month', 'central_id', 'technology'], inplace=True)
         df_availability.reset_index(drop=True, inplace=True)
@@ -524,18 +1571,20 @@ def process_technologies(df_availability):
     df_technologies = df_availability[['technology', 'technology_desc']].copy().drop_duplicates(subset=['technology', 'technology_desc'])
     df = pd.DataFrame(data=[['HID', 'Hidráulica'], ['EOL', 'Eólica'], ['BIOM', 'Biomasa'], ['MHID', 'MHID'], ['SOL', 'Solar'], ['HR', 'HR']],
         columns=['technology', 'technology_desc'])
-    df_technologies = pd.concat([df_technologies, df])
+    # Technologies on the availability sheet win over the fixed ones (a key can't be upserted twice on the same statement):
+    df_technologies = pd.concat([df_technologies, df]).drop_duplicates(subset=['technology'], keep='first')
     return df_technologies
 
-def process_impo_expo(file, month):
+def process_impo_expo(file, month, with_schema=True):
     bool_raise = False
     error_txt = ''
+    df_import_export = pd.DataFrame()
     try:
-        df_import_export = pd.read_excel(file, sheet_name='IMP-EXP', header=27, usecols='A:E', decimal=',')
-        cols = ['year', 'month', 'pais', 'import_export_type', 'monthly_energy_mwh']
-        df_import_export.columns = cols
+        df_import_export = read_monthly_sheet(file, 'impo_expo')
         df_import_export = df_import_export[df_import_export.month==month+'-01']
         df_import_export['year'] = df_import_export.month.dt.year
+        if with_schema:
+            df_import_export = apply_sheet_schema(df_import_export, 'impo_expo')
 
         df_import_export.sort_values(by=['month', 'import_export_type', 'pais'], inplace=True)
         df_import_export.reset_index(drop=True, inplace=True)
@@ -605,8 +1654,7 @@ def process_tariffs(df_demand):
     try:
         df_tariffs = df_demand[['tariff_desc', 'tariff_categ']].drop_duplicates(subset=['tariff_desc', 'tariff_categ']).\
             sort_values(by='tariff_desc')
-        df_tariffs['tariff_id'] = df_tariffs.apply(lambda x: 
-            hashlib.sha1(str.encode(x.tariff_desc.strip().lower()+x.tariff_categ.strip().lower())).hexdigest()[:10], axis=1)
+        df_tariffs['tariff_id'] = sha1_id(df_tariffs, ['tariff_desc', 'tariff_categ'])
         df_tariffs.reset_index(drop=True, inplace=True)
     except Exception as err:
         formatted_lines = traceback.format_exc().splitlines()
@@ -630,39 +1678,167 @@ def process_machines(df_gen):
         error_txt = 'process_machines - Error processing data.' + '\n' + txt
     return bool_raise, error_txt, df_machines
 
-###### Daily Process
-def _get_monthly_data(date, database, host, user, password, port, verbose=True):
-    """ Web scrapping of Cammesa's web to download monthly data (from PARAM date %Y-%m-%d %H:%M) and upserts tables for months
-        since max month in database.
+def monthly_base_files(data_path, base):
+    """ Paths of the workbooks of a monthly base (base format: YYYY-mm) once unzipped on data_path.
     """
-    error_txt = ''
-    process_ok = True
-    if not date:
-        date=datetime.now()
-    # [1] Connect to database
-    process_ok, error_txt, cnxn, cursor = build_postgres_cnxn(database=database, host=host, user=user, password=password
-                                        , port=port, verbose=verbose)
+    base_path = os.path.join(data_path, base.replace('-', '_'), 'BASE_INFORME_MENSUAL_'+base)
+    return {
+        'demand': os.path.join(base_path, 'Bases_Demanda_INFORME_MENSUAL', 'Demanda Mensual.xlsx'),
+        'gen': os.path.join(base_path, 'Bases_Oferta_INFORME_MENSUAL', 'Generación Local Mensual.xlsx'),
+        'prices': os.path.join(base_path, 'Bases_Adicionales_INFORME_MENSUAL', 'Precios Mensuales.xlsx'),
+        'fuels': os.path.join(base_path, 'Bases_Oferta_INFORME_MENSUAL', 'Combustibles Mensual.xlsx'),
+        'avail': os.path.join(base_path, 'Bases_Oferta_INFORME_MENSUAL', 'Disponibilidad Mensual.xlsx'),
+        'impo_expo': os.path.join(base_path, 'Bases_Adicionales_INFORME_MENSUAL', 'Import-Export Mensual.xlsx'),
+    }
+
+def files_sha1(files):
+    """ sha1 of the content of a list of files (missing files only contribute with their name).
+    """
+    sha1 = hashlib.sha1()
+    for file in files:
+        sha1.update(str.encode(os.path.basename(file)))
+        if os.path.exists(file):
+            with open(file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha1.update(chunk)
+    return sha1.hexdigest()
+
+def is_month_loaded(month, source_hash, cursor):
+    """ True if month (format: YYYY-mm) is on cammesa_db.monthly_load_manifest loaded from the same source_hash.
+    """
+    sql_query = """SELECT source_hash
+                FROM cammesa_db.monthly_load_manifest
+                WHERE month = '""" + month + """-01'"""
+    process_ok, error_txt, df_manifest = pg_select_to_pandas(cursor, sql_query, verbose=False)
+    is_loaded = process_ok and df_manifest.shape[0] > 0 and df_manifest.source_hash[0].strip() == source_hash
     if not process_ok:
-        if verbose:
-            print('ERROR _get_monthly_data building postgres cnxn: ' + error_txt)
-        return process_ok
-    # [2] Retrieve last month loaded to database:
-    sql_query = """select max(month) as month
-                from cammesa_db.monthly_demand
-                """
-    process_ok, error_txt, df_monthly_demand = pg_select_to_pandas(cursor, sql_query, verbose=True)
+        error_txt = 'ERROR is_month_loaded calling subprocess: ' + error_txt
+    return process_ok, error_txt, is_loaded
+
+def load_month_atomic(month, tables, source_hash, parse_seconds, cnxn, cursor):
+    """ Upserts all the tables of a month (list of (table, df, primary_key_cols)) in a single transaction and records
+        the load on cammesa_db.monthly_load_manifest. If any upsert fails the whole month is rolled back.
+    """
+    bool_raise = False
+    error_txt = ''
+    load_start = datetime.now()
+    row_counts = {}
+    totals = {'inserted': 0, 'updated': 0, 'skipped': 0}
+    for table, df, primary_key_cols in tables:
+        bool_raise, error_txt, counts = upsert(table, df, primary_key_cols, cnxn, cursor, commit=False)
+        if bool_raise:
+            break
+        row_counts[table] = df.shape[0]
+        for key in totals:
+            totals[key] += counts[key]
+    if not bool_raise:
+        df_manifest = pd.DataFrame(data=[[month+'-01', source_hash, json.dumps(row_counts), totals['inserted'], totals['updated']
+                                        , totals['skipped'], parse_seconds, (datetime.now() - load_start).total_seconds()]]
+            , columns=['month', 'source_hash', 'row_counts', 'rows_inserted', 'rows_updated', 'rows_skipped', 'parse_seconds'
+                       , 'load_seconds'])
+        bool_raise, error_txt, counts = upsert('cammesa_db.monthly_load_manifest', df_manifest, ['month'], cnxn, cursor
+                                               , commit=False)
+    if not bool_raise:
+        bool_raise, error_txt = set_watermark('monthly_bases', datetime.strptime(month, '%Y-%m'), cursor)
+    if bool_raise:
+        cnxn.rollback()
+        error_txt = 'load_month_atomic - Month ' + month + ' rolled back, nothing was loaded. ' + error_txt
+    else:
+        cnxn.commit()
+        print('INFO load_month_atomic - Month ' + month + ' loaded in one transaction. Inserted: ' + str(totals['inserted']) +\
+              ' Updated: ' + str(totals['updated']) + ' Skipped (unchanged): ' + str(totals['skipped']))
+    return bool_raise, error_txt
+
+def build_monthly_tables(frames):
+    """ From the frames parsed from the six workbooks of a month (keys of MONTHLY_WORKBOOKS) derives the master tables
+        and returns the list of (table, df, primary_key_cols) to upsert, master tables first so foreign keys are satisfied.
+    """
+    bool_raise = False
+    error_txt = ''
+    tables = []
+    df_demand, df_gen, df_fuels, df_availability = frames['demand'], frames['gen'], frames['fuels'], frames['avail']
+    ##### TECHNOLOGIES
+    df_technologies = process_technologies(df_availability)
+    ##### AGENTS
+    bool_raise, error_txt, df_agents = process_agents(df_demand, df_gen)
+    ##### TARIFFS
+    if not bool_raise:
+        bool_raise, error_txt, df_tariffs = process_tariffs(df_demand)
+    ##### MACHINES
+    if not bool_raise:
+        bool_raise, error_txt, df_machines = process_machines(df_gen)
+    if not bool_raise:
+        # frames are consumed: columns not stored on the monthly tables are dropped in place
+        df_demand.drop(columns=['agent_desc', 'agent_dem_type', 'tariff_desc', 'tariff_categ'], inplace=True)
+        df_gen.drop(columns=['machine_code', 'agent_desc', 'machine_type', 'source_gen', 'technology', 'hidraulic_categ'], inplace=True)
+        df_fuels.drop(columns=['machine_code', 'agent_desc', 'machine_type', 'source_gen', 'technology'], inplace=True)
+        df_availability.drop(columns=['agent_desc', 'technology_desc'], inplace=True)
+        tables = [
+            ('cammesa_db.monthly_prices', frames['prices'], ['month']),
+            ('cammesa_db.gen_technologies', df_technologies, ['technology']),
+            ('cammesa_db.monthly_import_export', frames['impo_expo'], ['month', 'pais', 'import_export_type']),
+            ('cammesa_db.agents', df_agents, ['agent_id']),
+            ('cammesa_db.tariffs', df_tariffs, ['tariff_id']),
+            ('cammesa_db.gen_machines', df_machines, ['machine_id']),
+            ('cammesa_db.monthly_demand', df_demand, ['month', 'agent_id', 'region_desc', 'tariff_id']),
+            ('cammesa_db.monthly_gen', df_gen, ['month', 'machine_id', 'agent_id']),
+            ('cammesa_db.monthly_combustibles', df_fuels, ['month', 'machine_id', 'agent_id', 'combustible_type']),
+            ('cammesa_db.monthly_availability', df_availability, ['month', 'central_id', 'agent_id', 'technology']),
+        ]
+    return bool_raise, error_txt, tables
+
+# Workbooks of a monthly base and the routine that processes each one of them (same keys as monthly_base_files).
+# Routines take (file, month, with_schema=True); with_schema=False skips apply_sheet_schema (see benchmark_monthly_memory).
+MONTHLY_WORKBOOKS = {
+    'demand': process_demand,
+    'gen': process_gen,
+    'prices': process_prices,
+    'fuels': process_fuels,
+    'avail': process_avail,
+    'impo_expo': process_impo_expo,
+}
+
+def monthly_data_path():
+    """ Folder where monthly bases are downloaded and unzipped. With several workers it must be a shared volume.
+    """
+    return os.path.join(os.getcwd(), 'airflow', 'dags', 'data')
+
+def get_bases_to_download(date, cursor, verbose=True):
+    """ Months (format YYYY-mm) from the one after the last loaded to the month of date. Months are loaded on their own
+        (mapped task groups) and the watermark never moves backwards, so a month that failed while a later one was loaded
+        is behind the watermark: months between the first one on cammesa_db.monthly_load_manifest and the watermark without
+        a manifest record are listed again.
+    """
+    # Retrieve last month loaded to database. Watermark on ingestion_state, or max month on the table the first time:
+    bases_to_download = []
+    process_ok, error_txt, last_month = get_watermark('monthly_bases', cursor)
     if not process_ok:
-        if verbose:
-            print('ERROR _get_monthly_data quering for last month on DB. Sql query: ' + sql_query + " " + error_txt)
-        return process_ok
-    df_monthly_demand.month = pd.to_datetime(df_monthly_demand.month)
-    last_month = df_monthly_demand.iloc[0].month
+        return process_ok, error_txt, bases_to_download
+    if last_month is None:
+        sql_query = """select max(month) as month
+                    from cammesa_db.monthly_demand
+                    """
+        process_ok, error_txt, df_monthly_demand = pg_select_to_pandas(cursor, sql_query, verbose=verbose)
+        if not process_ok:
+            return process_ok, 'Sql query: ' + sql_query + " " + error_txt, bases_to_download
+        df_monthly_demand.month = pd.to_datetime(df_monthly_demand.month)
+        last_month = df_monthly_demand.iloc[0].month
+    else:
+        sql_query = """SELECT to_char(m.month, 'YYYY-MM') AS month
+                    FROM generate_series((SELECT min(month) FROM cammesa_db.monthly_load_manifest)
+                        , '""" + last_month.strftime('%Y-%m-01') + """'::date, interval '1 month') AS m(month)
+                    WHERE NOT EXISTS (SELECT 1 FROM cammesa_db.monthly_load_manifest l WHERE l.month = m.month)
+                    ORDER BY m.month"""
+        process_ok, error_txt, df_missing = pg_select_to_pandas(cursor, sql_query, verbose=verbose)
+        if not process_ok:
+            return process_ok, 'Sql query: ' + sql_query + " " + error_txt, bases_to_download
+        if df_missing.shape[0] > 0:
+            print('WARNING get_bases_to_download - Months behind the watermark not loaded: ' + ', '.join(df_missing.month))
+        bases_to_download += df_missing.month.tolist()
     next_month = datetime(last_month.year, last_month.month, monthrange(last_month.year, last_month.month)[1], 0, 0) +\
         timedelta(days=1)
-    # [3] Make a list with the months to process (may be none)
     # Considering DAGs should be able to process any time, we consider the situation when a month is not processed and we have to process
     # a range of months:
-    bases_to_download = []
     today = date.date()
     current_month = datetime(today.year, today.month, 1, 0, 0, 0)
     month = next_month
@@ -670,7 +1846,12 @@ def _get_monthly_data(date, database, host, user, password, port, verbose=True):
         bases_to_download.append(month.strftime("%Y-%m")) # format: YYYY-mm
         month = datetime(month.year, month.month, monthrange(month.year, month.month)[1], 0, 0) + timedelta(days=1)
     print('Months to Download: ', bases_to_download)
-    # [4] Web scrapping: read Cammesa's web page adn look for dynamics url for each month to process
+    return process_ok, error_txt, bases_to_download
+
+def get_monthly_base_urls(bases_to_download):
+    """ Web scrapping: read Cammesa's web page and look for dynamics url for each month to process. Returns {base: url}
+        (months not published yet are not on it).
+    """
     url = 'https://cammesaweb.cammesa.com/informe-sintesis-mensual/#'
     page = requests.get(url)
     soup = BeautifulSoup(page.text, 'html.parser')
@@ -686,144 +1867,371 @@ def _get_monthly_data(date, database, host, user, password, port, verbose=True):
             if 'base' in  url and ('2021-09-2' if base == '2022-11' else base) in url:
                 print(url, 'zip')
                 files_url_dct[base] = url
-    # [5] Download zip files with monthly report. Save it in /home/airflow/dags/data
-    dirpath = os.getcwd()
-    data_path = os.path.join(dirpath, 'airflow', 'dags', 'data')
+    return files_url_dct
+
+def download_monthly_base(base, url, data_path):
+    """ Downloads the zip file of a monthly base to data_path, unzips it and then removes the .zip file.
+    """
+    bool_raise, error_txt = download_file(url=url, dest_folder=data_path, dest_file='base_informe_mensual_'+base+'.zip')
+    zip_file = os.path.join(data_path, 'base_informe_mensual_'+ base + '.zip')
+    if not bool_raise and os.path.exists(zip_file):
+        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+            zip_ref.extractall(os.path.join(data_path, base.replace('-', '_')))
+        ## If file exists, delete it: if os.path.isfile(myfile):
+        os.remove(zip_file)
+    return bool_raise, error_txt
+
+def monthly_parquet_file(data_path, base, workbook):
+    """ Path of the parquet file with the processed workbook of a monthly base.
+    """
+    return os.path.join(data_path, base.replace('-', '_'), 'parquet', workbook + '.parquet')
+
+###### Daily Process
+def _get_monthly_data(date, database, host, user, password, port, atomic_load=True, verbose=True):
+    """ Web scrapping of Cammesa's web to download monthly data (from PARAM date %Y-%m-%d %H:%M) and upserts tables for months
+        since max month in database.
+        atomic_load=True: all tables of a month are loaded in one transaction (see load_month_atomic). A month already
+        loaded from the same files is skipped. With atomic_load=False each table is upserted and committed on its own.
+        The same steps, split in a task group mapped by month, are _list_monthly_bases, _download_monthly_base,
+        _parse_monthly_base and _load_monthly_base.
+    """
+    error_txt = ''
+    process_ok = True
+    if not date:
+        date=datetime.now()
+    # [1] Connect to database
+    process_ok, error_txt, cnxn, cursor = build_postgres_cnxn(database=database, host=host, user=user, password=password
+                                        , port=port, verbose=verbose)
+    if not process_ok:
+        if verbose:
+            print('ERROR _get_monthly_data building postgres cnxn: ' + error_txt)
+        return process_ok
+    # [2] and [3] Make a list with the months to process (may be none)
+    process_ok, error_txt, bases_to_download = get_bases_to_download(date, cursor, verbose=verbose)
+    if not process_ok:
+        if verbose:
+            print('ERROR _get_monthly_data quering for last month on DB. ' + error_txt)
+        return process_ok
+    # [4] Web scrapping: look for the url of each month to process
+    files_url_dct = get_monthly_base_urls(bases_to_download)
+    # [5] and [6] Download zip files with monthly report. Save it in /home/airflow/dags/data and unzip
+    data_path = monthly_data_path()
     for base in files_url_dct:
-        download_file(url=files_url_dct[base], dest_folder=data_path, dest_file='base_informe_mensual_'+base+'.zip')
-    # [6] Unzip and then remove .zip file
-    for base in bases_to_download:
-        zip_file = os.path.join(data_path, 'base_informe_mensual_'+ base + '.zip')
-        if os.path.exists(zip_file):
-            with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-                zip_ref.extractall(os.path.join(data_path, base.replace('-', '_')))
-            ## If file exists, delete it: if os.path.isfile(myfile):
-            os.remove(zip_file)
+        bool_raise, error_txt = download_monthly_base(base, files_url_dct[base], data_path)
+        if bool_raise:
+            print(error_txt)
     # If this process founds error, it will continue with the next dataset, because should be prepared for re-processing
-    i=0
     bool_raise = False
+    month_failed = False
     for base in bases_to_download:
-        if True:
-        #if i == 0:
-            file = os.path.join(data_path, base.replace('-', '_'), 'BASE_INFORME_MENSUAL_'+base, 'Bases_Demanda_INFORME_MENSUAL'
-                , 'Demanda Mensual.xlsx')
-            # We only check the first file if exists (we asume the rest will also exists):
-            if os.path.exists(file):
-                ####### DEMAND
-                bool_raise, error_txt, df_demand = process_demand(file, base)
-                if bool_raise:
-                    print(error_txt)
-                ####### GENERATION
-                file = os.path.join(data_path, base.replace('-', '_'), 'BASE_INFORME_MENSUAL_'+base, 'Bases_Oferta_INFORME_MENSUAL'
-                    , 'Generación Local Mensual.xlsx')
-                bool_raise, error_txt, df_gen = process_gen(file, base)
-                if bool_raise:
-                    print(error_txt)
-                ###### PRICES
-                file = os.path.join(data_path, base.replace('-', '_'), 'BASE_INFORME_MENSUAL_'+base, 'Bases_Adicionales_INFORME_MENSUAL'
-                    , 'Precios Mensuales.xlsx')
-                bool_raise, error_txt, df_prices = process_prices(file, base)
-                if bool_raise:
-                    print(error_txt)
-                ###### COMBUSTIBLES
-                file = os.path.join(data_path, base.replace('-', '_'), 'BASE_INFORME_MENSUAL_'+base, 'Bases_Oferta_INFORME_MENSUAL'
-                    , 'Combustibles Mensual.xlsx')
-                bool_raise, error_txt, df_fuels = process_fuels(file, base)
-                if bool_raise:
-                    print(error_txt)
-                ###### AVAILABILITY
-                file = os.path.join(data_path, base.replace('-', '_'), 'BASE_INFORME_MENSUAL_'+base, 'Bases_Oferta_INFORME_MENSUAL'
-                    , 'Disponibilidad Mensual.xlsx')
-                bool_raise, error_txt, df_availability = process_avail(file, base)
-                if bool_raise:
-                    print(error_txt)
-                ##### TECHNOLOGIES
-                df_technologies = process_technologies(df_availability)
-                ##### IMPO-EXPO
-                file = os.path.join(data_path, base.replace('-', '_'), 'BASE_INFORME_MENSUAL_'+base, 'Bases_Adicionales_INFORME_MENSUAL'
-                    , 'Import-Export Mensual.xlsx')
-                bool_raise, error_txt, df_impo_expo = process_impo_expo(file, base)
-                if bool_raise:
-                    print(error_txt)
-                ##### AGENTS
-                bool_raise, error_txt, df_agents = process_agents(df_demand, df_gen)
-                if bool_raise:
-                    print(error_txt)
-                ##### TARIFFS
-                bool_raise, error_txt, df_tariffs = process_tariffs(df_demand)
-                if bool_raise:
-                    print(error_txt)
-                ##### MACHINES
-                bool_raise, error_txt, df_machines = process_machines(df_gen)
-                if bool_raise:
-                    print(error_txt)
-                ##### UPSERT DATABASE
-                # Thinking that this process may need to be re-executed, instead of insert we use upsert:
-                table = 'cammesa_db.monthly_prices'
-                df = df_prices.copy()
-                primary_key_cols = ['month']
-                bool_raise, error_txt = upsert(table, df, primary_key_cols, cnxn, cursor)
-                if bool_raise:
-                    print(error_txt)
-                table = 'cammesa_db.gen_technologies'
-                df = df_technologies.copy()
-                primary_key_cols = ['technology']
-                bool_raise, error_txt = upsert(table, df, primary_key_cols, cnxn, cursor)
-                if bool_raise:
-                    print(error_txt)
-                table = 'cammesa_db.monthly_import_export'
-                df = df_impo_expo.copy()
-                primary_key_cols = ['month', 'pais', 'import_export_type']
-                bool_raise, error_txt = upsert(table, df, primary_key_cols, cnxn, cursor)
-                if bool_raise:
-                    print(error_txt)
-                table = 'cammesa_db.agents'
-                df = df_agents.copy()
-                primary_key_cols = ['agent_id']
-                bool_raise, error_txt = upsert(table, df, primary_key_cols, cnxn, cursor)
-                if bool_raise:
-                    print(error_txt)
-                table = 'cammesa_db.tariffs'
-                df = df_tariffs.copy()
-                primary_key_cols = ['tariff_id']
-                bool_raise, error_txt = upsert(table, df, primary_key_cols, cnxn, cursor)
-                if bool_raise:
-                    print(error_txt)
-                table = 'cammesa_db.gen_machines'
-                df = df_machines.copy()
-                primary_key_cols = ['machine_id']
-                bool_raise, error_txt = upsert(table, df, primary_key_cols, cnxn, cursor)
-                if bool_raise:
-                    print(error_txt)
-                table = 'cammesa_db.monthly_demand'
-                df_demand.drop(columns=['agent_desc', 'agent_dem_type', 'tariff_desc', 'tariff_categ'], inplace=True)
-                df = df_demand.copy()
-                primary_key_cols = ['month', 'agent_id', 'region_desc', 'tariff_id']
-                bool_raise, error_txt = upsert(table, df, primary_key_cols, cnxn, cursor)
+        files = monthly_base_files(data_path, base)
+        # We only check the first file if exists (we asume the rest will also exists):
+        if not os.path.exists(files['demand']):
+            continue
+        source_hash = None
+        if atomic_load:
+            # A month already loaded from the very same files is a no-op:
+            source_hash = files_sha1(list(files.values()))
+            process_ok, error_txt, is_loaded = is_month_loaded(base, source_hash, cursor)
+            if not process_ok:
+                print(error_txt)
+                month_failed = True
+                continue
+            if is_loaded:
+                print('INFO _get_monthly_data - Month ' + base + ' already loaded from the same source files. Skipped.')
+                continue
+        parse_start = datetime.now()
+        parse_raise = False
+        frames = {}
+        for workbook, process_workbook in MONTHLY_WORKBOOKS.items():
+            bool_raise, error_txt, frames[workbook] = process_workbook(files[workbook], base)
+            parse_raise = parse_raise or bool_raise
+            if bool_raise:
+                print(error_txt)
+        if not parse_raise:
+            bool_raise, error_txt, tables = build_monthly_tables(frames)
+            parse_raise = parse_raise or bool_raise
+            if bool_raise:
+                print(error_txt)
+        parse_seconds = (datetime.now() - parse_start).total_seconds()
+        del frames
+        ##### UPSERT DATABASE
+        # Thinking that this process may need to be re-executed, instead of insert we use upsert.
+        if parse_raise:
+            print('ERROR _get_monthly_data - Month ' + base + ' not loaded: errors processing its files.')
+            month_failed = True
+            continue
+        if atomic_load:
+            bool_raise, error_txt = load_month_atomic(base, tables, source_hash, parse_seconds, cnxn, cursor)
+            if bool_raise:
+                print(error_txt)
+                month_failed = True
+        else:
+            month_raise = False
+            for table, df, primary_key_cols in tables:
+                bool_raise, error_txt, counts = upsert(table, df, primary_key_cols, cnxn, cursor)
+                month_raise = month_raise or bool_raise
                 if bool_raise:
                     print(error_txt)
-                table = 'cammesa_db.monthly_gen'
-                df_gen.drop(columns=['machine_code', 'agent_desc', 'machine_type', 'source_gen', 'technology', 'hidraulic_categ'], inplace=True)
-                df = df_gen.copy()
-                primary_key_cols = ['month', 'machine_id', 'agent_id']
-                bool_raise, error_txt = upsert(table, df, primary_key_cols, cnxn, cursor)
+            if not month_raise:
+                bool_raise, error_txt = set_watermark('monthly_bases', datetime.strptime(base, '%Y-%m'), cursor)
                 if bool_raise:
                     print(error_txt)
-                table = 'cammesa_db.monthly_combustibles'
-                df_fuels.drop(columns=['machine_code', 'agent_desc', 'machine_type', 'source_gen', 'technology'], inplace=True)
-                df = df_fuels.copy()
-                primary_key_cols = ['month', 'machine_id', 'agent_id', 'combustible_type']
-                bool_raise, error_txt = upsert(table, df, primary_key_cols, cnxn, cursor)
+                cnxn.commit()
+        # Free this month's frames before parsing the next one:
+        del tables
+    process_ok = not (bool_raise or month_failed)
+    cnxn.close()
+    return process_ok
+
+def _list_monthly_bases(date, database, host, user, password, port, verbose=True):
+    """ First task of the mapped monthly load: months to process that are already published. Returns process_ok and a
+        list of {'base': YYYY-mm, 'url': url} (small enough for XCom, one mapped task per item).
+    """
+    bases = []
+    if not date:
+        date=datetime.now()
+    process_ok, error_txt, cnxn, cursor = build_postgres_cnxn(database=database, host=host, user=user, password=password
+                                        , port=port, verbose=verbose)
+    if not process_ok:
+        if verbose:
+            print('ERROR _list_monthly_bases building postgres cnxn: ' + error_txt)
+        return process_ok, bases
+    process_ok, error_txt, bases_to_download = get_bases_to_download(date, cursor, verbose=verbose)
+    cnxn.close()
+    if not process_ok:
+        if verbose:
+            print('ERROR _list_monthly_bases quering for last month on DB. ' + error_txt)
+        return process_ok, bases
+    files_url_dct = get_monthly_base_urls(bases_to_download)
+    bases = [{'base': base, 'url': files_url_dct[base]} for base in bases_to_download if base in files_url_dct]
+    return process_ok, bases
+
+def _download_monthly_base(base, url, verbose=True):
+    """ Mapped task: downloads and unzips one monthly base on monthly_data_path().
+    """
+    bool_raise, error_txt = download_monthly_base(base, url, monthly_data_path())
+    if bool_raise and verbose:
+        print('ERROR _download_monthly_base. ' + error_txt)
+    return not bool_raise
+
+def _parse_monthly_workbook(base, workbook, verbose=True):
+    """ Mapped task: processes one workbook (key of MONTHLY_WORKBOOKS) of a monthly base and saves the result as parquet
+        (monthly_parquet_file), to be read by _load_monthly_base. Data goes through files, not XCom.
+    """
+    data_path = monthly_data_path()
+    file = monthly_base_files(data_path, base)[workbook]
+    bool_raise, error_txt, df = MONTHLY_WORKBOOKS[workbook](file, base)
+    if not bool_raise:
+        try:
+            parquet_file = monthly_parquet_file(data_path, base, workbook)
+            os.makedirs(os.path.dirname(parquet_file), exist_ok=True)
+            df.to_parquet(parquet_file, index=False)
+            if verbose:
+                print('INFO _parse_monthly_workbook - ' + base + ' ' + workbook + ' saved to ' + parquet_file +\
+                      '. Rows: ' + str(df.shape[0]))
+        except Exception as err:
+            formatted_lines = traceback.format_exc().splitlines()
+            bool_raise = True
+            error_txt = 'Error saving parquet file. ' + ' '.join(formatted_lines)
+    if bool_raise and verbose:
+        print('ERROR _parse_monthly_workbook. ' + error_txt)
+    return not bool_raise
+
+def _parse_monthly_base(base, database, host, user, password, port, verbose=True):
+    """ Mapped task (one per month): parses the workbooks of a monthly base with _parse_monthly_workbook. Nothing is parsed
+        if the month is already loaded from the same source files, and a workbook whose parquet file is newer than its
+        Excel file (e.g. on a retry) is not parsed again.
+    """
+    process_ok, error_txt, cnxn, cursor = build_postgres_cnxn(database=database, host=host, user=user, password=password
+                                        , port=port, verbose=verbose)
+    if not process_ok:
+        if verbose:
+            print('ERROR _parse_monthly_base building postgres cnxn: ' + error_txt)
+        return process_ok
+    data_path = monthly_data_path()
+    files = monthly_base_files(data_path, base)
+    process_ok, error_txt, is_loaded = is_month_loaded(base, files_sha1(list(files.values())), cursor)
+    cnxn.close()
+    if not process_ok:
+        print('ERROR _parse_monthly_base. ' + error_txt)
+        return process_ok
+    if is_loaded:
+        print('INFO _parse_monthly_base - Month ' + base + ' already loaded from the same source files. Skipped.')
+        return process_ok
+    for workbook in MONTHLY_WORKBOOKS:
+        parquet_file = monthly_parquet_file(data_path, base, workbook)
+        if os.path.exists(parquet_file) and (not os.path.exists(files[workbook]) or
+                                             os.path.getmtime(parquet_file) > os.path.getmtime(files[workbook])):
+            if verbose:
+                print('INFO _parse_monthly_base - ' + base + ' ' + workbook + ' already parsed: ' + parquet_file)
+            continue
+        process_ok = _parse_monthly_workbook(base, workbook, verbose=verbose) and process_ok
+    return process_ok
+
+def _load_monthly_base(base, database, host, user, password, port, verbose=True):
+    """ Mapped task: loads the parquet files of a monthly base in one transaction (load_month_atomic). A month already
+        loaded from the same source files is a no-op.
+    """
+    process_ok, error_txt, cnxn, cursor = build_postgres_cnxn(database=database, host=host, user=user, password=password
+                                        , port=port, verbose=verbose)
+    if not process_ok:
+        if verbose:
+            print('ERROR _load_monthly_base building postgres cnxn: ' + error_txt)
+        return process_ok
+    data_path = monthly_data_path()
+    source_hash = files_sha1(list(monthly_base_files(data_path, base).values()))
+    process_ok, error_txt, is_loaded = is_month_loaded(base, source_hash, cursor)
+    if process_ok and is_loaded:
+        print('INFO _load_monthly_base - Month ' + base + ' already loaded from the same source files. Skipped.')
+    elif process_ok:
+        try:
+            frames = {workbook: pd.read_parquet(monthly_parquet_file(data_path, base, workbook)) for workbook in MONTHLY_WORKBOOKS}
+            bool_raise, error_txt, tables = build_monthly_tables(frames)
+            if not bool_raise:
+                bool_raise, error_txt = load_month_atomic(base, tables, source_hash, None, cnxn, cursor)
+        except Exception as err:
+            formatted_lines = traceback.format_exc().splitlines()
+            bool_raise = True
+            error_txt = 'Error reading parquet files of month ' + base + '. ' + ' '.join(formatted_lines)
+        process_ok = not bool_raise
+    if not process_ok and verbose:
+        print('ERROR _load_monthly_base. ' + error_txt)
+    cnxn.close()
+    return process_ok
+
+###### Weather history
+WEATHER_COLS = ['timestamp', 'temp', 'humidity', 'press', 'dd', 'wind', 'met_station']
+
+def parse_weather_file(file):
+    """ Parses a met station file of hourly observations into a DataFrame with WEATHER_COLS.
+        .csv files must already have WEATHER_COLS as header. Any other file is taken as SMN "datos horarios" fixed width
+        text: FECHA (ddmmyyyy) HORA TEMP HUM PNM DD FF NOMBRE, read with pd.read_fwf and the column limits of the dashed
+        line under the header. Rows without timestamp, station or temperature are dropped; other missing or non numeric
+        values are kept as NULL.
+        Timestamps are floored to the hour to be aligned with cammesa_db.hourly_demand.
+    """
+    bool_raise = False
+    error_txt = ''
+    df_weather = pd.DataFrame(columns=WEATHER_COLS)
+    try:
+        if file.lower().endswith('.csv'):
+            df_weather = pd.read_csv(file, usecols=WEATHER_COLS, parse_dates=['timestamp'])
+        else:
+            # Columns are located from the dashed line under the header. SMN leaves missing values blank, so fields can't be
+            # split by whitespace. Numbers are right aligned: each field goes from the end of the previous dashes to the
+            # end of its own; the station name (left aligned) goes to the end of the line.
+            with open(file, 'r', encoding='latin-1') as f:
+                lines = f.read().splitlines()
+            dash_row = next(i for i, line in enumerate(lines) if '-' in line and set(line.strip()) <= {'-', ' '})
+            ends = [m.end() for m in re.finditer(r'-+', lines[dash_row])]
+            colspecs = [(0, ends[0])] + [(ends[i - 1], ends[i]) for i in range(1, 7)] + [(ends[6], None)]
+            df = pd.read_fwf(io.StringIO('\n'.join(lines[dash_row + 1:])), colspecs=colspecs, header=None, dtype=str
+                             , names=['fecha', 'hora', 'temp', 'humidity', 'press', 'dd', 'wind', 'met_station'])
+            df['fecha'] = df.fecha.str.strip()
+            df = df[df.fecha.str.fullmatch(r'\d{8}', na=False)]
+            df_weather = pd.DataFrame()
+            df_weather['timestamp'] = pd.to_datetime(df.fecha, format='%d%m%Y', errors='coerce') +\
+                pd.to_timedelta(pd.to_numeric(df.hora, errors='coerce'), unit='h')
+            for col in ['temp', 'humidity', 'press', 'dd', 'wind']:
+                df_weather[col] = pd.to_numeric(df[col], errors='coerce')
+            df_weather['met_station'] = df.met_station
+        # SMN leaves values blank: only the temperature (the feature used by the models) is required
+        df_weather['met_station'] = df_weather.met_station.str.strip().str[:50].replace('', np.nan)
+        df_weather.dropna(subset=['timestamp', 'met_station', 'temp'], inplace=True)
+        df_weather['timestamp'] = df_weather.timestamp.dt.floor('H')
+        for col in ['humidity', 'dd', 'wind']:
+            df_weather[col] = pd.to_numeric(df_weather[col], errors='coerce').round().astype('Int64')
+        df_weather.drop_duplicates(subset=['timestamp', 'met_station'], keep='last', inplace=True)
+        df_weather = df_weather[WEATHER_COLS]
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        txt = ' '.join(formatted_lines)
+        bool_raise = True
+        error_txt = 'parse_weather_file - Error parsing file: ' + file + '\n' + txt
+    return bool_raise, error_txt, df_weather
+
+def _load_weather_history(files, database, host, user, password, port, max_workers=None, verbose=True):
+    """ Bulk load of met station files (one file per station/year, or SMN daily files) to cammesa_db.hourly_weather.
+        Files are parsed in parallel (one process per file) and spooled to a single csv that is loaded with one COPY to
+        a staging table and then merged (rows with the same values are not rewritten), all in one transaction.
+        A file that fails to parse is reported and the rest are loaded.
+    """
+    error_txt = ''
+    process_ok, error_txt, cnxn, cursor = build_postgres_cnxn(database=database, host=host, user=user, password=password
+                                        , port=port, verbose=verbose)
+    if not process_ok:
+        if verbose:
+            print('ERROR _load_weather_history building postgres cnxn: ' + error_txt)
+        return process_ok
+    upsert_user = getpass.getuser()
+    n_rows = 0
+    timestamp_max = None
+    files_raise = False
+    with tempfile.TemporaryFile(mode='w+', newline='') as spool:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(parse_weather_file, file): file for file in files}
+            for future in as_completed(futures):
+                bool_raise, error_txt, df_weather = future.result()
                 if bool_raise:
+                    files_raise = True
                     print(error_txt)
-                table = 'cammesa_db.monthly_availability'
-                df_availability.drop(columns=['agent_desc', 'technology_desc'], inplace=True)
-                df = df_availability.copy()
-                primary_key_cols = ['month', 'central_id', 'agent_id', 'technology']
-                bool_raise, error_txt = upsert(table, df, primary_key_cols, cnxn, cursor)
+                    continue
+                if df_weather.shape[0] == 0:
+                    continue
+                df_weather.to_csv(spool, header=False, index=False, date_format='%Y-%m-%d %H:%M:%S')
+                n_rows += df_weather.shape[0]
+                file_max = df_weather.timestamp.max().to_pydatetime()
+                timestamp_max = file_max if timestamp_max is None else max(timestamp_max, file_max)
+                if verbose:
+                    print('INFO _load_weather_history - ' + futures[future] + ' parsed. Rows: ' + str(df_weather.shape[0]))
+        spool.seek(0)
+        try:
+            cursor.execute("""CREATE TEMP TABLE hourly_weather_stage
+                            (LIKE cammesa_db.hourly_weather INCLUDING DEFAULTS) ON COMMIT DROP""")
+            cursor.copy_expert('COPY hourly_weather_stage (' + ', '.join(WEATHER_COLS) + ') FROM STDIN WITH (FORMAT csv)', spool)
+            # The same station and hour may come in more than one file: keep one of them.
+            cursor.execute("""INSERT INTO cammesa_db.hourly_weather AS t
+                        (timestamp, temp, humidity, press, dd, wind, met_station, create_user, create_date, update_user, update_date)
+                        SELECT DISTINCT ON (timestamp, met_station) timestamp, temp, humidity, press, dd, wind, met_station
+                            , %s, now(), %s, now()
+                        FROM hourly_weather_stage
+                        ON CONFLICT (timestamp, met_station) DO UPDATE
+                        SET temp=EXCLUDED.temp, humidity=EXCLUDED.humidity, press=EXCLUDED.press, dd=EXCLUDED.dd
+                        , wind=EXCLUDED.wind, update_user=EXCLUDED.update_user, update_date=EXCLUDED.update_date""" +\
+                        _distinct_where_clause(['temp', 'humidity', 'press', 'dd', 'wind']) + ';', (upsert_user, upsert_user))
+            n_upserted = cursor.rowcount
+            if timestamp_max is not None:
+                bool_raise, error_txt = set_watermark('hourly_weather', timestamp_max, cursor)
                 if bool_raise:
-                    print(error_txt)
-        i+=1    
-    process_ok = not bool_raise
+                    raise ValueError(error_txt)
+            cnxn.commit()
+            print('INFO _load_weather_history - ' + str(n_rows) + ' rows copied, ' + str(n_upserted) +\
+                  ' inserted or updated. Table cammesa_db.hourly_weather.')
+        except Exception as err:
+            cnxn.rollback()
+            formatted_lines = traceback.format_exc().splitlines()
+            txt = ' '.join(formatted_lines)
+            process_ok = False
+            print('ERROR _load_weather_history - Error loading cammesa_db.hourly_weather. Nothing was loaded.\n' + txt)
     cnxn.close()
-    return process_ok
\ No newline at end of file
+    return process_ok and not files_raise
+
+def get_hourly_demand_weather(cursor, timestamp_from, timestamp_to, met_stations, region_code=1002, verbose=True):
+    """ Hourly demand with the weather of met_stations as columns (temp_<i>, humidity_<i>, press_<i>, wind_<i>, in
+        met_stations order), built with one query. Both tables are keyed on the hour, so no per-hour lookups are needed.
+    """
+    select_cols = ''
+    joins = ''
+    for i, met_station in enumerate(met_stations):
+        alias = 'w' + str(i)
+        select_cols += ', ' + ', '.join([alias + '.' + col + ' AS ' + col + '_' + str(i) for col in ['temp', 'humidity', 'press', 'wind']])
+        joins += ' LEFT JOIN cammesa_db.hourly_weather ' + alias + ' ON ' + alias + '.timestamp = d.timestamp AND ' +\
+                 alias + ".met_station = '" + met_station.replace("'", "''") + "'"
+    sql_query = """SELECT d.timestamp, d.hourly_demand, d.hourly_temp, d.day_of_week, d.is_holiday""" + select_cols + """
+                FROM cammesa_db.hourly_demand d""" + joins + """
+                WHERE d.region_code = """ + str(region_code) + """
+                AND d.timestamp >= '""" + timestamp_from.strftime('%Y-%m-%d %H:%M') + """'
+                AND d.timestamp <= '""" + timestamp_to.strftime('%Y-%m-%d %H:%M') + """'
+                ORDER BY d.timestamp"""
+    return pg_select_to_pandas(cursor, sql_query, verbose=verbose)
@@ -0,0 +1,247 @@
+"""
+    monthly_legacy.py
+    The monthly workbooks pipeline as it was before the MONTHLY_SHEETS schema (energy.py): sheets read without names nor
+    dtypes, ids hashed row by row, a copy of each frame handed to upsert and audit columns added to the frames. It is not
+    used by the DAGs: it is the reference of energy.benchmark_monthly_memory.
+"""
+import hashlib
+import getpass
+import traceback
+from datetime import datetime
+
+import pandas as pd
+
+from energy import process_agents, process_machines
+
+def process_demand(file, month):
+    bool_raise = False
+    error_txt = ''
+    df_demand = pd.DataFrame()
+    try:
+        df_demand = pd.read_excel(file, sheet_name='DEMANDA', header=23, usecols='A:L', decimal=',')
+        # Rename columns for ease:
+        cols = ['year', 'month', 'agent_id', 'agent_desc', 'agent_dem_type', 'region_desc', 'prov_desc'
+                , 'area_categ', 'demand_categ', 'tariff_desc', 'tariff_categ', 'monthly_demand_mwh']
+        df_demand.columns = cols
+        df_demand = df_demand[df_demand.month==month+'-01']
+        # There are agents with leading o trailing spaces on desc, those spaces are removed to avoid build distinc ids on
+        # master table
+        df_demand['agent_desc'] = df_demand.agent_desc.str.strip()
+        df_demand['tariff_id'] = df_demand.apply(lambda x: 
+                hashlib.sha1(str.encode(x.tariff_desc.strip().lower()+x.tariff_categ.strip().lower())).hexdigest()[:10], axis=1)
+        df_demand.sort_values(by=['month', 'agent_id'], inplace=True)
+        df_demand.reset_index(drop=True, inplace=True)
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        txt = ' '.join(formatted_lines)
+        bool_raise = True
+        error_txt = 'process_demand - Error retrieving data from Excel: ' +  file + '\n' + txt
+    return bool_raise, error_txt, df_demand
+
+def process_gen(file, month):
+    bool_raise = False
+    error_txt = ''
+    try:
+        df_gen = pd.read_excel(file, sheet_name='GENERACION', header=21, usecols='A:O', decimal=',')
+        cols = ['year', 'month', 'machine_code', 'central_id', 'agent_id', 'agent_desc', 'region_desc', 'prov_desc', 'pais'
+                , 'machine_type', 'source_gen', 'technology', 'hidraulic_categ', 'region_categ', 'monthly_gen_mwh']
+        df_gen.columns = cols
+        df_gen = df_gen[df_gen.month==month+'-01']
+
+        df_gen['agent_id'] = df_gen.agent_id.str.strip()
+        df_gen['agent_desc'] = df_gen.agent_desc.str.strip()
+        df_gen['machine_code'] = df_gen.machine_code.str.strip()
+        df_gen.prov_desc.fillna('', inplace=True)
+
+        # only 1 country --> remove this column
+        df_gen.drop(columns='pais', inplace=True)
+
+        df_gen.sort_values(by=['month', 'machine_code'], inplace=True)
+        df_gen.reset_index(drop=True, inplace=True)
+
+        df_gen['machine_id'] = df_gen.apply(lambda x: 
+            hashlib.sha1(str.encode(x.machine_code.strip().lower()+x.machine_type.strip().lower()+x.technology.strip().lower())).hexdigest()[:10], axis=1)
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        txt = ' '.join(formatted_lines)
+        bool_raise = True
+        error_txt = 'process_gen - Error retrieving data from Excel: ' +  file + '\n' + txt
+    return bool_raise, error_txt, df_gen
+
+def process_prices(file, month):
+    bool_raise = False
+    error_txt = ''
+    try:
+        df_precios = pd.read_excel(file, sheet_name='PRECIOS', header=4, decimal=',') #, usecols='A:CE'
+        df_precios.drop(columns=['COMPONENTES GENERALES'], inplace=True)
+        df_precios.set_index(keys=['DETALLE'], inplace=True)
+        df_precios = df_precios.T
+        df_precios.reset_index(inplace=True)
+        cols = ['month', 'energia', 'energia_ad', 'sobrecost_comb', 'sobrecost_transit_despacho', 'cargo_demanda_exced_real'
+            , 'cta_brasil_abast_MEM', 'compra_conj_MEM'
+            , 'pot_despachada', 'pot_serv_asoc', 'pot_res_corto_plzo_serv_res_intantanea', 'pot_res_med_plzo', 'monodico'
+            , 'transp_alta_tens_distrib_troncal', 'transp_alta_tens', 'transp_distrib_troncal', 'monodico_transp'
+            , 'monodico_ponder_estacional_otr_ingr'
+            , 'monodico_ponder_estacional_transp']
+        df_precios.columns = cols
+        df_precios = df_precios[df_precios.month==month+'-01']
+        df_precios.month = df_precios.month.dt.date
+
+        df_precios.sort_values(by=['month'], inplace=True)
+        df_precios.reset_index(drop=True, inplace=True)
+
+        #df_precios['carg_dem_exce_cta_brasil_contrat_abas_MEM'].fillna(0, inplace=True)
+        df_precios.pot_despachada.fillna(0, inplace=True)
+        df_precios.pot_serv_asoc.fillna(0, inplace=True)
+        df_precios.compra_conj_MEM.fillna(0, inplace=True)
+        df_precios['monodico_ponder_estacional_transp'].fillna(0, inplace=True)
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        txt = ' '.join(formatted_lines)
+        bool_raise = True
+        error_txt = 'process_prices - Error retrieving data from Excel: ' +  file + '\n' + txt
+    return bool_raise, error_txt, df_precios
+
+def process_fuels(file, month):
+    bool_raise = False
+    error_txt = ''
+    try:
+        df_fuels = pd.read_excel(file, sheet_name='COMBUSTIBLES', header=21, usecols='A:M', decimal=',')
+        df_fuels.drop(columns=['REGION', 'PROVINCIA'], inplace=True)
+
+        cols = ['year', 'month', 'machine_code', 'central_id', 'agent_id', 'agent_desc', 'machine_type', 'source_gen', 'technology'
+            , 'combustible_type', 'monthly_consume']
+        df_fuels.columns = cols
+        df_fuels = df_fuels[df_fuels.month==month+'-01']
+
+        df_fuels['agent_id'] = df_fuels.agent_id.str.strip()
+        df_fuels['agent_desc'] = df_fuels.agent_desc.str.strip()
+        df_fuels['machine_code'] = df_fuels.machine_code.str.strip()
+
+        df_fuels.sort_values(by=['month', 'machine_code'], inplace=True)
+        df_fuels.reset_index(drop=True, inplace=True)
+
+        df_fuels['machine_id'] = df_fuels.apply(lambda x: 
+            hashlib.sha1(str.encode(x.machine_code.strip().lower()+x.machine_type.strip().lower()+x.technology.strip().lower())).hexdigest()[:10], axis=1)
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        txt = ' '.join(formatted_lines)
+        bool_raise = True
+        error_txt = 'process_fuels - Error retrieving data from Excel: ' +  file + '\n' + txt
+    return bool_raise, error_txt, df_fuels
+
+def process_avail(file, month):
+    bool_raise = False
+    error_txt = ''
+    try:
+        df_availability = pd.read_excel(file, sheet_name='DISPONIBILIDAD x CENTRAL', header=21, usecols='A:G', decimal=',')
+        cols = ['month', 'central_id', 'agent_id', 'agent_desc', 'technology_desc', 'technology', 'monthly_availability_factor']
+        df_availability.columns = cols
+        df_availability = df_availability[df_availability.month==month+'-01']
+
+        df_availability['agent_id'] = df_availability.agent_id.str.strip()
+        df_availability['central_id'] = df_availability.central_id.str.strip()
+        df_availability['year'] = df_availability.month.dt.year
+
+        df_availability.sort_values(by=['month', 'central_id', 'technology'], inplace=True)
+        df_availability.reset_index(drop=True, inplace=True)
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        txt = ' '.join(formatted_lines)
+        bool_raise = True
+        error_txt = 'process_avail - Error retrieving data from Excel: ' +  file + '\n' + txt
+    return bool_raise, error_txt, df_availability
+
+def process_technologies(df_availability):
+    df_technologies = df_availability[['technology', 'technology_desc']].copy().drop_duplicates(subset=['technology', 'technology_desc'])
+    df = pd.DataFrame(data=[['HID', 'Hidráulica'], ['EOL', 'Eólica'], ['BIOM', 'Biomasa'], ['MHID', 'MHID'], ['SOL', 'Solar'], ['HR', 'HR']],
+        columns=['technology', 'technology_desc'])
+    df_technologies = pd.concat([df_technologies, df])
+    return df_technologies
+
+def process_impo_expo(file, month):
+    bool_raise = False
+    error_txt = ''
+    try:
+        df_import_export = pd.read_excel(file, sheet_name='IMP-EXP', header=27, usecols='A:E', decimal=',')
+        cols = ['year', 'month', 'pais', 'import_export_type', 'monthly_energy_mwh']
+        df_import_export.columns = cols
+        df_import_export = df_import_export[df_import_export.month==month+'-01']
+        df_import_export['year'] = df_import_export.month.dt.year
+
+        df_import_export.sort_values(by=['month', 'import_export_type', 'pais'], inplace=True)
+        df_import_export.reset_index(drop=True, inplace=True)
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        txt = ' '.join(formatted_lines)
+        bool_raise = True
+        error_txt = 'process_impo_expo - Error retrieving data from Excel: ' +  file + '\n' + txt
+    return bool_raise, error_txt, df_import_export
+
+def process_tariffs(df_demand):
+    bool_raise = False
+    error_txt = ''
+    try:
+        df_tariffs = df_demand[['tariff_desc', 'tariff_categ']].drop_duplicates(subset=['tariff_desc', 'tariff_categ']).\
+            sort_values(by='tariff_desc')
+        df_tariffs['tariff_id'] = df_tariffs.apply(lambda x: 
+            hashlib.sha1(str.encode(x.tariff_desc.strip().lower()+x.tariff_categ.strip().lower())).hexdigest()[:10], axis=1)
+        df_tariffs.reset_index(drop=True, inplace=True)
+    except Exception as err:
+        formatted_lines = traceback.format_exc().splitlines()
+        txt = ' '.join(formatted_lines)
+        bool_raise = True
+        error_txt = 'process_tariffs - Error processing data.' + '\n' + txt
+    return bool_raise, error_txt, df_tariffs
+
+def build_month_tables(files, month):
+    """ Processes the workbooks of a month (files as returned by monthly_base_files) and returns bool_raise, error_txt
+        and the list of (table, df, primary_key_cols) that _get_monthly_data upserted.
+    """
+    bool_raise, error_txt, df_demand = process_demand(files['demand'], month)
+    if not bool_raise:
+        bool_raise, error_txt, df_gen = process_gen(files['gen'], month)
+    if not bool_raise:
+        bool_raise, error_txt, df_prices = process_prices(files['prices'], month)
+    if not bool_raise:
+        bool_raise, error_txt, df_fuels = process_fuels(files['fuels'], month)
+    if not bool_raise:
+        bool_raise, error_txt, df_availability = process_avail(files['avail'], month)
+    if not bool_raise:
+        df_technologies = process_technologies(df_availability)
+        bool_raise, error_txt, df_impo_expo = process_impo_expo(files['impo_expo'], month)
+    if not bool_raise:
+        bool_raise, error_txt, df_agents = process_agents(df_demand, df_gen)
+    if not bool_raise:
+        bool_raise, error_txt, df_tariffs = process_tariffs(df_demand)
+    if not bool_raise:
+        bool_raise, error_txt, df_machines = process_machines(df_gen)
+    if bool_raise:
+        return bool_raise, error_txt, []
+    df_demand.drop(columns=['agent_desc', 'agent_dem_type', 'tariff_desc', 'tariff_categ'], inplace=True)
+    df_gen.drop(columns=['machine_code', 'agent_desc', 'machine_type', 'source_gen', 'technology', 'hidraulic_categ'], inplace=True)
+    df_fuels.drop(columns=['machine_code', 'agent_desc', 'machine_type', 'source_gen', 'technology'], inplace=True)
+    df_availability.drop(columns=['agent_desc', 'technology_desc'], inplace=True)
+    tables = [
+        ('cammesa_db.monthly_prices', df_prices.copy(), ['month']),
+        ('cammesa_db.gen_technologies', df_technologies.copy(), ['technology']),
+        ('cammesa_db.monthly_import_export', df_impo_expo.copy(), ['month', 'pais', 'import_export_type']),
+        ('cammesa_db.agents', df_agents.copy(), ['agent_id']),
+        ('cammesa_db.tariffs', df_tariffs.copy(), ['tariff_id']),
+        ('cammesa_db.gen_machines', df_machines.copy(), ['machine_id']),
+        ('cammesa_db.monthly_demand', df_demand.copy(), ['month', 'agent_id', 'region_desc', 'tariff_id']),
+        ('cammesa_db.monthly_gen', df_gen.copy(), ['month', 'machine_id', 'agent_id']),
+        ('cammesa_db.monthly_combustibles', df_fuels.copy(), ['month', 'machine_id', 'agent_id', 'combustible_type']),
+        ('cammesa_db.monthly_availability', df_availability.copy(), ['month', 'central_id', 'agent_id', 'technology']),
+    ]
+    return bool_raise, error_txt, tables
+
+def upsert_rows(df):
+    """ Columns and rows (tuples) that upsert sent for df: audit columns were added to df.
+    """
+    user=getpass.getuser()
+    df['create_date'] = datetime.now()
+    df['create_user'] = user
+    df['update_date'] = datetime.now()
+    df['update_user'] = user
+    return df.columns.tolist(), [tuple(r) for r in df.to_numpy()]
@@ -0,0 +1,45 @@
+"""
+    stan_cache.py
+    Compiled Stan models cached in memory and on disk by the hash of their code. No database imports: it can be used by
+    the DAGs (stan_monthly) and by stand alone scripts.
+"""
+import os
+import pickle
+import hashlib
+import tempfile
+
+# pip install pystan==2.19.1.1
+import pystan
+
+_stan_models = {}
+
+def stan_cache_dir():
+    """ Folder of the compiled models. With several workers it must be a shared volume.
+    """
+    return os.path.join(os.getcwd(), 'airflow', 'dags', 'stan_cache')
+
+def get_stan_model(model_code, cache_dir=None, verbose=True):
+    """ Compiled pystan.StanModel of model_code. Looked up in memory, then on cache_dir (pickle named by the sha1 of the
+        code and the pystan version); compiled and saved only if not found. The pickle is written to a temporary file and
+        renamed, so workers compiling at the same time never read a half written model.
+    """
+    key = hashlib.sha1(str.encode(model_code + pystan.__version__)).hexdigest()
+    if key in _stan_models:
+        return _stan_models[key]
+    cache_dir = cache_dir if cache_dir else stan_cache_dir()
+    cache_file = os.path.join(cache_dir, 'stan_model_' + key + '.pkl')
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            model = pickle.load(f)
+        if verbose:
+            print('INFO get_stan_model - Compiled model loaded from ' + cache_file)
+    else:
+        if verbose:
+            print('INFO get_stan_model - Compiling model. It will be saved to ' + cache_file)
+        model = pystan.StanModel(model_code=model_code)
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp', delete=False) as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, cache_file)
+    _stan_models[key] = model
+    return model
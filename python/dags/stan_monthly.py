@@ -0,0 +1,148 @@
+"""
+    stan_monthly.py
+    Bayesian model (Stan) for the monthly electricity demand of Argentina: trend + yearly seasonality + AR(1) errors.
+    Compiled models are cached on disk by the hash of their code (see stan_cache), so they are compiled once and reused
+    by every run and worker process. Chains run in parallel.
+"""
+import traceback
+
+import numpy as np
+import pandas as pd
+
+from datetime import datetime
+
+from energy import build_postgres_cnxn, pg_select_to_pandas, upsert
+from stan_cache import get_stan_model
+
+# y: demand scaled. t: time in years (N history + H forecast). X: fourier terms of the yearly seasonality.
+MONTHLY_STAN_CODE = """
+data {
+    int<lower=2> N;
+    int<lower=1> H;
+    int<lower=1> K;
+    vector[N] y;
+    vector[N + H] t;
+    matrix[N + H, 2 * K] X;
+}
+parameters {
+    real alpha;
+    real beta;
+    vector[2 * K] gamma;
+    real<lower=-1, upper=1> phi;
+    real<lower=0> sigma;
+}
+model {
+    vector[N] mu = alpha + beta * t[1:N] + X[1:N] * gamma;
+    alpha ~ normal(0, 5);
+    beta ~ normal(0, 1);
+    gamma ~ normal(0, 1);
+    phi ~ normal(0, 0.5);
+    sigma ~ normal(0, 1);
+    y[1] ~ normal(mu[1], sigma / sqrt(1 - square(phi)));
+    y[2:N] ~ normal(mu[2:N] + phi * (y[1:(N - 1)] - mu[1:(N - 1)]), sigma);
+}
+generated quantities {
+    vector[N] y_fit;
+    vector[H] y_forecast;
+    {
+        vector[N + H] mu = alpha + beta * t + X * gamma;
+        real resid = y[N] - mu[N];
+        y_fit[1] = mu[1];
+        for (n in 2:N)
+            y_fit[n] = mu[n] + phi * (y[n - 1] - mu[n - 1]);
+        for (h in 1:H) {
+            resid = normal_rng(phi * resid, sigma);
+            y_forecast[h] = mu[N + h] + resid;
+        }
+    }
+}
+"""
+MONTHLY_STAN_MODEL_ID = 'stan_ar1'
+
+def fit_monthly_demand(y, n_forecast=6, n_fourier=3, chains=4, iter=2000, n_jobs=-1, seed=42, verbose=True):
+    """ Fits MONTHLY_STAN_CODE to the monthly series y (np.array, oldest first). Chains run in parallel (n_jobs=-1: all cores).
+        Returns (fitted, forecast) in the scale of y: fitted has the one step ahead posterior mean of each month of history,
+        forecast a DataFrame with mean, p10, p50 and p90 of the next n_forecast months.
+    """
+    n = len(y)
+    y_mean, y_std = y.mean(), y.std()
+    t = np.arange(n + n_forecast) / 12
+    X = np.column_stack([f(2 * np.pi * k * t) for k in range(1, n_fourier + 1) for f in (np.sin, np.cos)])
+    data = {'N': n, 'H': n_forecast, 'K': n_fourier, 'y': (y - y_mean) / y_std, 't': t, 'X': X}
+    model = get_stan_model(MONTHLY_STAN_CODE, verbose=verbose)
+    fit = model.sampling(data=data, chains=chains, iter=iter, n_jobs=n_jobs, seed=seed)
+    samples = fit.extract(pars=['y_fit', 'y_forecast'])
+    fitted = samples['y_fit'].mean(axis=0) * y_std + y_mean
+    y_forecast = samples['y_forecast'] * y_std + y_mean
+    forecast = pd.DataFrame({'mean': y_forecast.mean(axis=0)})
+    for q in [0.1, 0.5, 0.9]:
+        forecast['p' + str(int(q * 100))] = np.quantile(y_forecast, q, axis=0)
+    return fitted, forecast
+
+###### Daily Process
+def _monthly_bayes_forecast(date, database, host, user, password, port, n_forecast=6, verbose=True):
+    """ Fits the Bayesian model to the national monthly demand and saves the experiment on cammesa_db.experiments (in
+        sample MAPE; experiment_date is the last month of history, so the horizon of a forecast is month - experiment_date)
+        and cammesa_db.experiments_detail (history with one step ahead fit, and the posterior mean, P10 and P90 of the next
+        n_forecast months). One experiment per last month of history: if it exists nothing is done.
+    """
+    error_txt = ''
+    if not date:
+        date=datetime.now()
+    process_ok, error_txt, cnxn, cursor = build_postgres_cnxn(database=database, host=host, user=user, password=password
+                                        , port=port, verbose=verbose)
+    if not process_ok:
+        if verbose:
+            print('ERROR _monthly_bayes_forecast building postgres cnxn: ' + error_txt)
+        return process_ok
+    sql_query = """SELECT month, SUM(monthly_demand_mwh) AS monthly_demand_mwh
+                FROM cammesa_db.monthly_demand
+                GROUP BY month
+                ORDER BY month"""
+    process_ok, error_txt, df_hist = pg_select_to_pandas(cursor, sql_query, verbose=verbose)
+    if not process_ok or df_hist.shape[0] < 24:
+        if verbose:
+            print('ERROR _monthly_bayes_forecast - Not enough monthly history. ' + error_txt)
+        cnxn.close()
+        return False
+    df_hist.month = pd.to_datetime(df_hist.month)
+    experiment_id = 'STAN' + df_hist.month.iloc[-1].strftime('%Y%m')
+    process_ok, error_txt, df_exp = pg_select_to_pandas(cursor, """SELECT experiment_id FROM cammesa_db.experiments
+                                                        WHERE experiment_id = '""" + experiment_id + "'", verbose=False)
+    if process_ok and df_exp.shape[0] > 0:
+        if verbose:
+            print('INFO _monthly_bayes_forecast - Experiment ' + experiment_id + ' already exists. Nothing to do.')
+        cnxn.close()
+        return process_ok
+    try:
+        y = df_hist.monthly_demand_mwh.astype(float).to_numpy()
+        fitted, forecast = fit_monthly_demand(y, n_forecast=n_forecast, verbose=verbose)
+        mape = float(np.mean(np.abs(fitted - y) / y) * 100)
+        df_experiment = pd.DataFrame(data=[[experiment_id, df_hist.month.iloc[-1].date(), MONTHLY_STAN_MODEL_ID, mape]]
+                                     , columns=['experiment_id', 'experiment_date', 'model_id', 'mape'])
+        df_detail = pd.DataFrame({'experiment_id': experiment_id, 'month': df_hist.month.dt.date, 'hist_value': y
+                                  , 'forecast_value': fitted, 'forecast_p10': np.nan, 'forecast_p90': np.nan})
+        future_months = pd.date_range(start=df_hist.month.iloc[-1], periods=n_forecast + 1, freq='MS')[1:]
+        df_future = pd.DataFrame({'experiment_id': experiment_id, 'month': future_months.date, 'hist_value': np.nan
+                                  , 'forecast_value': forecast['mean'], 'forecast_p10': forecast.p10, 'forecast_p90': forecast.p90})
+        df_detail = pd.concat([df_detail, df_future], ignore_index=True).replace({np.nan: None})
+        bool_raise, error_txt, counts = upsert('cammesa_db.experiments', df_experiment, ['experiment_id'], cnxn, cursor
+                                               , commit=False)
+        if not bool_raise:
+            bool_raise, error_txt, counts = upsert('cammesa_db.experiments_detail', df_detail, ['experiment_id', 'month']
+                                                   , cnxn, cursor, commit=False)
+        if bool_raise:
+            cnxn.rollback()
+            process_ok = False
+            print('ERROR _monthly_bayes_forecast - ' + error_txt)
+        else:
+            cnxn.commit()
+            if verbose:
+                print('INFO _monthly_bayes_forecast - Experiment ' + experiment_id + ' saved. In sample MAPE: ' + str(round(mape, 2)))
+    except Exception as err:
+        cnxn.rollback()
+        formatted_lines = traceback.format_exc().splitlines()
+        process_ok = False
+        print('ERROR _monthly_bayes_forecast - Error fitting the model. ' + ' '.join(formatted_lines))
+    cnxn.close()
+    return process_ok
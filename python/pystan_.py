@@ -1,8 +1,11 @@
 import multiprocessing
 multiprocessing.set_start_method("spawn")
 
-import pystan
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dags'))
+from stan_cache import get_stan_model
 model_code = 'parameters {real y;} model {y ~ normal(0,1);}'
-model = pystan.StanModel(model_code=model_code)  # this will take a minute
-y = model.sampling(n_jobs=1).extract()['y']
-y.mean()  # should be close to 0
\ No newline at end of file
+model = get_stan_model(model_code=model_code)  # this will take a minute the first time, then it is read from the cache
+y = model.sampling(n_jobs=-1).extract()['y']
+y.mean()  # should be close to 0
@@ -337,25 +337,26 @@ TABLESPACE pg_default;
 ALTER TABLE IF EXISTS cammesa_db.experiments_detail
     OWNER to postgres;
 
--- Table: cammesa_db.hourly_historic_demand
---DROP TABLE IF EXISTS cammesa_db.hourly_historic_demand
-CREATE TABLE IF NOT EXISTS cammesa_db.hourly_historic_demand
+-- Table: cammesa_db.hourly_weather
+-- Hourly observations of the met stations. Loaded by _load_weather_history. SMN leaves values blank: only temp is required.
+--DROP TABLE IF EXISTS cammesa_db.hourly_weather
+CREATE TABLE IF NOT EXISTS cammesa_db.hourly_weather
 (
 	timestamp		timestamp without time zone	NOT NULL,
 	temp     		double precision	NOT NULL,
-    humidity		int					NOT NULL,
-	press			double precision	NOT NULL,
-    dd				int					NOT NULL,
-    wind			int					NOT NULL,
+    humidity		int					NULL,
+	press			double precision	NULL,
+    dd				int					NULL,
+    wind			int					NULL,
 	met_station		character(50)	 	NOT NULL,
 	create_user 	character(10) COLLATE pg_catalog."default",
     create_date 	timestamp without time zone,
     update_user 	character(10) COLLATE pg_catalog."default",
     update_date 	timestamp without time zone,
-    CONSTRAINT hourly_historic_demand_pk PRIMARY KEY (timestamp, met_station)
+    CONSTRAINT hourly_weather_pk PRIMARY KEY (timestamp, met_station)
 )
 TABLESPACE pg_default;
-ALTER TABLE IF EXISTS cammesa_db.hourly_historic_demand
+ALTER TABLE IF EXISTS cammesa_db.hourly_weather
     OWNER to postgres;
 
 -- Table: cammesa_db.hourly_historic_demand
@@ -380,3 +381,205 @@ CREATE TABLE IF NOT EXISTS cammesa_db.hourly_historic_demand
 TABLESPACE pg_default;
 ALTER TABLE IF EXISTS cammesa_db.hourly_historic_demand
     OWNER to postgres;
+
+-- Table: cammesa_db.monthly_load_manifest
+-- One record per month loaded by _get_monthly_data (atomic load): source files hash, row counts and timings.
+--DROP TABLE IF EXISTS cammesa_db.monthly_load_manifest
+CREATE TABLE IF NOT EXISTS cammesa_db.monthly_load_manifest
+(
+	month			date				NOT NULL,
+	source_hash		character(40)		NOT NULL,
+	row_counts		text				NULL,
+	rows_inserted	int					NOT NULL,
+	rows_updated	int					NOT NULL,
+	rows_skipped	int					NOT NULL,
+	parse_seconds	double precision	NULL,
+	load_seconds	double precision	NULL,
+	create_user 	character(10) COLLATE pg_catalog."default",
+    create_date 	timestamp without time zone,
+    update_user 	character(10) COLLATE pg_catalog."default",
+    update_date 	timestamp without time zone,
+    CONSTRAINT monthly_load_manifest_pk PRIMARY KEY (month)
+)
+TABLESPACE pg_default;
+ALTER TABLE IF EXISTS cammesa_db.monthly_load_manifest
+    OWNER to postgres;
+
+-- Table: cammesa_db.ingestion_state
+-- Watermark (last timestamp loaded) per source: monthly_bases, hourly_demand_<region_code>, holidays_<year>.
+--DROP TABLE IF EXISTS cammesa_db.ingestion_state
+CREATE TABLE IF NOT EXISTS cammesa_db.ingestion_state
+(
+	source			character varying(40)	NOT NULL,
+	watermark		timestamp without time zone	NOT NULL,
+	create_user 	character(10) COLLATE pg_catalog."default",
+    create_date 	timestamp without time zone,
+    update_user 	character(10) COLLATE pg_catalog."default",
+    update_date 	timestamp without time zone,
+    CONSTRAINT ingestion_state_pk PRIMARY KEY (source)
+)
+TABLESPACE pg_default;
+ALTER TABLE IF EXISTS cammesa_db.ingestion_state
+    OWNER to postgres;
+
+-- Table: cammesa_db.holidays
+--DROP TABLE IF EXISTS cammesa_db.holidays
+CREATE TABLE IF NOT EXISTS cammesa_db.holidays
+(
+	holiday_date	date				NOT NULL,
+	holiday_desc	character varying(100)	NULL,
+	create_user 	character(10) COLLATE pg_catalog."default",
+    create_date 	timestamp without time zone,
+    update_user 	character(10) COLLATE pg_catalog."default",
+    update_date 	timestamp without time zone,
+    CONSTRAINT holidays_pk PRIMARY KEY (holiday_date)
+)
+TABLESPACE pg_default;
+ALTER TABLE IF EXISTS cammesa_db.holidays
+    OWNER to postgres;
+
+-- Columns to know which model and which last hour of history produced each hourly forecast
+ALTER TABLE IF EXISTS cammesa_db.hourly_demand_forecast
+    ADD COLUMN IF NOT EXISTS model_id character(10) NULL,
+    ADD COLUMN IF NOT EXISTS forecast_base_timestamp timestamp without time zone NULL;
+
+-- Table: cammesa_db.forecast_accuracy
+-- Running aggregates of forecast errors by frequency (H: hourly, M: monthly), region, model and horizon.
+-- Updated incrementally by _monitor_forecast_accuracy. Region 0: total Argentina (monthly).
+--DROP TABLE IF EXISTS cammesa_db.forecast_accuracy
+CREATE TABLE IF NOT EXISTS cammesa_db.forecast_accuracy
+(
+	frequency		character(1)		NOT NULL,
+	region_code		integer				NOT NULL,
+	model_id		character(10)		NOT NULL,
+	horizon			integer				NOT NULL,
+	n				bigint				NOT NULL,
+	sum_ape			double precision	NOT NULL,
+	sum_error		double precision	NOT NULL,
+	sum_abs_error	double precision	NOT NULL,
+	sum_actual		double precision	NOT NULL,
+	last_timestamp	timestamp without time zone	NULL,
+	create_user 	character(10) COLLATE pg_catalog."default",
+    create_date 	timestamp without time zone,
+    update_user 	character(10) COLLATE pg_catalog."default",
+    update_date 	timestamp without time zone,
+    CONSTRAINT forecast_accuracy_pk PRIMARY KEY (frequency, region_code, model_id, horizon)
+)
+TABLESPACE pg_default;
+ALTER TABLE IF EXISTS cammesa_db.forecast_accuracy
+    OWNER to postgres;
+
+-- Table: cammesa_db.hourly_demand_forecast_history
+-- Every hourly forecast by its base hour (hourly_demand_forecast only keeps the last one of each hour). Read by
+-- _monitor_forecast_accuracy by region and timestamp of the actuals, the first columns of the key.
+--DROP TABLE IF EXISTS cammesa_db.hourly_demand_forecast_history
+CREATE TABLE IF NOT EXISTS cammesa_db.hourly_demand_forecast_history
+(
+	region_code				integer				NOT NULL,
+	timestamp				timestamp without time zone	NOT NULL,
+	forecast_base_timestamp	timestamp without time zone	NOT NULL,
+	model_id				character(10)		NOT NULL,
+	hourly_demand_forecast	integer				NOT NULL,
+	hourly_demand_p10		integer				NULL,
+	hourly_demand_p50		integer				NULL,
+	hourly_demand_p90		integer				NULL,
+	create_user 	character(10) COLLATE pg_catalog."default",
+    create_date 	timestamp without time zone,
+    update_user 	character(10) COLLATE pg_catalog."default",
+    update_date 	timestamp without time zone,
+    CONSTRAINT hourly_demand_forecast_history_pk PRIMARY KEY (region_code, timestamp, forecast_base_timestamp, model_id)
+)
+TABLESPACE pg_default;
+ALTER TABLE IF EXISTS cammesa_db.hourly_demand_forecast_history
+    OWNER to postgres;
+
+-- View: cammesa_db.forecast_accuracy_v
+-- MAPE (%), bias and WAPE (%) from the running aggregates, to be read by dashboards.
+CREATE OR REPLACE VIEW cammesa_db.forecast_accuracy_v AS
+SELECT frequency, region_code, model_id, horizon, n
+	, 100 * sum_ape / NULLIF(n, 0) AS mape
+	, sum_error / NULLIF(n, 0) AS bias
+	, 100 * sum_abs_error / NULLIF(sum_actual, 0) AS wape
+	, last_timestamp
+FROM cammesa_db.forecast_accuracy;
+
+-- Prediction interval of each hourly forecast (MC dropout or bootstrap of recent errors; NULL when not available)
+ALTER TABLE IF EXISTS cammesa_db.hourly_demand_forecast
+    ADD COLUMN IF NOT EXISTS hourly_demand_p10 integer NULL,
+    ADD COLUMN IF NOT EXISTS hourly_demand_p50 integer NULL,
+    ADD COLUMN IF NOT EXISTS hourly_demand_p90 integer NULL;
+
+-- Forecast interval of each month (posterior quantiles of the Bayesian models)
+ALTER TABLE IF EXISTS cammesa_db.experiments_detail
+    ADD COLUMN IF NOT EXISTS forecast_p10 double precision NULL,
+    ADD COLUMN IF NOT EXISTS forecast_p90 double precision NULL;
+
+-- Table: cammesa_db.hourly_lstm_state
+-- LSTM state (h, c of each layer, npz) after the last hour used by the stateful hourly forecast, with the scaler context.
+--DROP TABLE IF EXISTS cammesa_db.hourly_lstm_state
+CREATE TABLE IF NOT EXISTS cammesa_db.hourly_lstm_state
+(
+	region_code		integer				NOT NULL,
+	model_id		character(10)		NOT NULL,
+	state_timestamp	timestamp without time zone	NOT NULL,
+	model_hash		character(40)		NOT NULL,
+	scaler_min		double precision	NOT NULL,
+	scaler_max		double precision	NOT NULL,
+	steps			integer				NOT NULL,
+	state			bytea				NOT NULL,
+	create_user 	character(10) COLLATE pg_catalog."default",
+    create_date 	timestamp without time zone,
+    update_user 	character(10) COLLATE pg_catalog."default",
+    update_date 	timestamp without time zone,
+    CONSTRAINT hourly_lstm_state_pk PRIMARY KEY (region_code, model_id)
+)
+TABLESPACE pg_default;
+ALTER TABLE IF EXISTS cammesa_db.hourly_lstm_state
+    OWNER to postgres;
+
+-- Table: cammesa_db.hourly_demand_gaps
+-- Missing hours of cammesa_db.hourly_demand per region, as ranges [gap_start, gap_end] (both included). Kept up to date by
+-- each hourly ingestion, so the forecast and the backfill find holes without scanning hourly_demand.
+--DROP TABLE IF EXISTS cammesa_db.hourly_demand_gaps
+CREATE TABLE IF NOT EXISTS cammesa_db.hourly_demand_gaps
+(
+	region_code		integer				NOT NULL,
+	gap_start		timestamp without time zone	NOT NULL,
+	gap_end			timestamp without time zone	NOT NULL,
+	create_user 	character(10) COLLATE pg_catalog."default",
+    create_date 	timestamp without time zone,
+    update_user 	character(10) COLLATE pg_catalog."default",
+    update_date 	timestamp without time zone,
+    CONSTRAINT hourly_demand_gaps_pk PRIMARY KEY (region_code, gap_start)
+)
+TABLESPACE pg_default;
+ALTER TABLE IF EXISTS cammesa_db.hourly_demand_gaps
+    OWNER to postgres;
+CREATE INDEX IF NOT EXISTS hourly_demand_gaps_end_idx
+    ON cammesa_db.hourly_demand_gaps USING btree (region_code, gap_end);
+
+-- Temperature quality flag of each hour ('missing' / 'out_of_range'; NULL if Ok). Flagged temperatures are saved as NULL:
+-- the demand of the hour is still valid.
+ALTER TABLE IF EXISTS cammesa_db.hourly_demand
+    ALTER COLUMN hourly_temp DROP NOT NULL,
+    ADD COLUMN IF NOT EXISTS temp_flag character varying(20) NULL;
+
+-- Table: cammesa_db.hourly_demand_rejected
+-- Hours rejected by the data quality rules for their demand (they remain as gaps). _backfill_hourly_gaps does not request
+-- them again. A row is deleted when the hour is loaded.
+--DROP TABLE IF EXISTS cammesa_db.hourly_demand_rejected
+CREATE TABLE IF NOT EXISTS cammesa_db.hourly_demand_rejected
+(
+	region_code		integer				NOT NULL,
+	timestamp		timestamp without time zone	NOT NULL,
+	hourly_demand	double precision	NULL,
+	reason			character varying(20)	NOT NULL,
+	create_user 	character(10) COLLATE pg_catalog."default",
+    create_date 	timestamp without time zone,
+    update_user 	character(10) COLLATE pg_catalog."default",
+    update_date 	timestamp without time zone,
+    CONSTRAINT hourly_demand_rejected_pk PRIMARY KEY (region_code, timestamp)
+)
+TABLESPACE pg_default;
+ALTER TABLE IF EXISTS cammesa_db.hourly_demand_rejected
+    OWNER to postgres;